@@ -0,0 +1,85 @@
+#! /usr/bin/python3
+"""
+Check that split_default parses global-defaults lines exactly like
+get_default, and time both. Lines with a backslash are the exception:
+get_default stays escaped after the first one, so those lines are only
+counted, and split_default is checked against known parses of escapes.
+
+    bench/defaults.py [--lines N] [--fuzz N] [FILE]
+
+Lines are read from FILE (e.g. ambig and unambig output pasted together
+with a tab, as prepare_data combines them) or generated: dictionary-like
+units plus random strings of the characters the parsers care about.
+Exits with status 1 if any line without a backslash is parsed
+differently, or an escape is parsed wrongly.
+"""
+
+import os, sys, random, argparse
+from time import perf_counter
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from llformat import get_default, split_defaults
+
+# (line, split_default of it) for escaped characters
+escaped_lines = [
+    ('^a\\/b<n>/c<n>$', ('a/b', 'n', 'c', 'n')),
+    ('^w\\\\<n>/W<n>$', ('w\\', 'n', 'W', 'n')),
+    ('^a\\<b<n>/c\\$d<adj>$', ('a<b', 'n', 'c$d', 'adj')),
+    ('\\^x ^a<n>/b<n>$', ('a', 'n', 'b', 'n')),
+    ('^a\\q<vblex><pres>/b<vblex>\\<x\\><pres>/c<n>$', ('aq', 'vblex.pres', 'b', 'vblex.<x>pres')),
+]
+
+def dictionary_lines(count, rand):
+    tags = ['<n>', '<vblex>', '<adj>', '<pr>', '<det><def>', '<sg>', '<pl>', '<pres>', '<m>', '<f>']
+    def unit(lemma, ntls):
+        sl = lemma + ''.join(rand.sample(tags, rand.randint(0, 3)))
+        tls = [lemma.upper() + str(k) + ''.join(rand.sample(tags, rand.randint(0, 3))) for k in range(ntls)]
+        return '^{}/{}$'.format(sl, '/'.join(tls))
+    for k in range(count):
+        lemma = 'w{}'.format(rand.randrange(10000))
+        if rand.random() < 0.05:
+            lemma = lemma.replace('w', 'w\\/' if rand.random() < 0.5 else 'w\\\\')
+        ntls = rand.randint(1, 3)
+        yield '{}\t{}'.format(unit(lemma, ntls), unit(lemma, 1))
+
+def fuzz_lines(count, rand):
+    alphabet = '^$/<>\\\tab. '
+    for k in range(count):
+        yield ''.join(rand.choice(alphabet) for _ in range(rand.randint(0, 30)))
+
+def timed(func, lines):
+    btime = perf_counter()
+    result = func(lines)
+    return result, perf_counter() - btime
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('file', nargs='?')
+    parser.add_argument('--lines', type=int, default=200000)
+    parser.add_argument('--fuzz', type=int, default=100000)
+    args = parser.parse_args()
+
+    rand = random.Random(1)
+    if args.file:
+        with open(args.file, 'r', encoding='utf-8') as ifile:
+            lines = [line.rstrip('\n') for line in ifile]
+    else:
+        lines = list(dictionary_lines(args.lines, rand))
+    lines.extend(fuzz_lines(args.fuzz, rand))
+
+    expected, slow = timed(lambda lines: [get_default(line) for line in lines], lines)
+    result, fast = timed(lambda lines: list(split_defaults(lines)), lines)
+    mismatches = [(line, want, got) for line, want, got in zip(lines, expected, result)
+                  if want != got and '\\' not in line]
+    escaped = sum(want != got for line, want, got in zip(lines, expected, result) if '\\' in line)
+    for line, want, got in mismatches[:10]:
+        print('{!r}: get_default {} split_default {}'.format(line, want, got))
+    wrong = [(line, want, got) for line, want in escaped_lines
+             for got in split_defaults([line]) if want != got]
+    for line, want, got in wrong:
+        print('{!r}: expected {} split_default {}'.format(line, want, got))
+
+    print('{} lines, {} parsed differently, {} with a backslash parsed differently by get_default'.format(
+        len(lines), len(mismatches), escaped))
+    print('get_default    {:.3f}s  {:.0f} lines/s'.format(slow, len(lines) / slow))
+    print('split_defaults {:.3f}s  {:.0f} lines/s  ({:.1f}x)'.format(fast, len(lines) / fast, slow / fast))
+    sys.exit(1 if mismatches or wrong else 0)
@@ -0,0 +1,150 @@
+#! /usr/bin/python3
+"""
+Time every stage of lexlearner.py on synthetic corpora of several sizes.
+
+    bench/run.py [--scales 1000,10000] [--vocab N] [--ambiguity P]
+                 [--work DIR] [--out FILE] [--compare FILE] [--set NAME=VALUE ...]
+
+For each scale a corpus and language pair are generated with synth.py,
+and lexlearner.py runs against the stand-in tools in bench/tools with a
+config that points at them (plus any --set overrides). The stages of its
+run report are summed by name and printed. With --out, the results are
+saved as JSON. With --compare, they are checked against saved results:
+the exit status is 1 if the CPU time of this process or the peak RSS of
+a stage grew by more than --tolerance.
+"""
+
+import os, re, sys, json, shutil, argparse, tempfile, subprocess
+from time import perf_counter
+bench = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, bench)
+import synth
+
+repo = os.path.dirname(bench)
+tools = os.path.join(bench, 'tools')
+
+# changes below these are noise
+min_cpu_seconds = 0.2
+min_rss_kb = 10240
+
+def write_config(work, pair_data, corpus_folder, lines, settings):
+    """
+    Write work/llconfig.py: the repo config pointed at the synthetic data and stand-in tools.
+    """
+    with open(os.path.join(repo, 'llconfig.py'), 'r', encoding='utf-8') as ifile:
+        config = ifile.read()
+    paths = {'corpus_folder': corpus_folder, 'corpus_name': 'synthetic',
+             'corpus_pair_name': 'es-en', 'apertium_pair_name': 'en-es',
+             'pair_data': pair_data, 'source': 'en', 'target': 'es',
+             'lextools': os.path.join(tools, 'lextools'), 'moses': os.path.join(tools, 'moses'),
+             'giza': os.path.join(tools, 'giza'), 'data_folder': os.path.join(work, 'data'),
+             'maxlines': lines}
+    for name, value in paths.items():
+        config = re.sub(r'^{} ?=.*$'.format(name), '{} = {!r}'.format(name, value), config, flags=re.M)
+    config += '\n# bench/run.py\n' + ''.join('{}\n'.format(setting) for setting in settings)
+    with open(os.path.join(work, 'llconfig.py'), 'w', encoding='utf-8') as ofile:
+        ofile.write(config)
+
+def run_lexlearner(work):
+    """
+    Run lexlearner.py in work, where its llconfig.py is found first.
+    """
+    env = dict(os.environ, PYTHONPATH=repo,
+               PATH=os.path.join(tools, 'bin') + os.pathsep + os.environ.get('PATH', ''))
+    command = 'import runpy; runpy.run_path({!r}, run_name="__main__")'.format(os.path.join(repo, 'lexlearner.py'))
+    with open(os.path.join(work, 'log'), 'w') as log:
+        status = subprocess.call([sys.executable, '-W', 'ignore', '-c', command],
+                                 cwd=work, env=env, stdout=log, stderr=subprocess.STDOUT)
+    if status != 0:
+        sys.exit('lexlearner.py failed with status {}, see {}'.format(status, os.path.join(work, 'log')))
+
+def stage_totals(report):
+    """
+    Sum the records of every stage name in a run report, in order of first appearance.
+    """
+    totals = {}
+    for record in report['stages']:
+        total = totals.setdefault(record['stage'], dict.fromkeys(
+            ('calls', 'wall_seconds', 'cpu_seconds', 'child_cpu_seconds', 'lines_in', 'lines_out',
+             'bytes_in', 'bytes_out', 'peak_rss_kb', 'peak_child_rss_kb'), 0))
+        total['calls'] += 1
+        for field in ('wall_seconds', 'cpu_seconds', 'child_cpu_seconds', 'lines_in', 'lines_out', 'bytes_in', 'bytes_out'):
+            total[field] += record[field]
+        for field in ('peak_rss_kb', 'peak_child_rss_kb'):
+            total[field] = max(total[field], record[field])
+        total['peak_rss_scope'] = record.get('peak_rss_scope', 'stage')
+    for total in totals.values():
+        for field in ('wall_seconds', 'cpu_seconds', 'child_cpu_seconds'):
+            total[field] = round(total[field], 3)
+        wall = total['wall_seconds']
+        total['lines_per_second'] = round((total['lines_in'] or total['lines_out']) / wall, 1) if wall > 0 else None
+    return totals
+
+def print_totals(lines, wall, totals):
+    print('{} lines, {:.2f}s'.format(lines, wall))
+    print('  {:<28} {:>8} {:>8} {:>8} {:>10} {:>10} {:>12}'.format(
+        'stage', 'wall', 'cpu', 'children', 'rss MB', 'child MB', 'lines/s'))
+    for name, total in totals.items():
+        print('  {:<28} {:>8.2f} {:>8.2f} {:>8.2f} {:>9.1f}{:1} {:>10.1f} {:>12}'.format(
+            name, total['wall_seconds'], total['cpu_seconds'], total['child_cpu_seconds'],
+            total['peak_rss_kb'] / 1024, '*' if total['peak_rss_scope'] == 'process' else '',
+            total['peak_child_rss_kb'] / 1024, total['lines_per_second'] or '-'))
+    if any(total['peak_rss_scope'] == 'process' for total in totals.values()):
+        print('  * peak RSS of the whole process: stages ran at the same time (stage_jobs > 1)')
+
+def regressions(results, baseline, tolerance):
+    """
+    Describe the stages whose CPU time or peak RSS grew by more than tolerance.
+    """
+    found = []
+    for lines, result in results.items():
+        for name, total in result['stages'].items():
+            old = baseline.get(lines, {}).get('stages', {}).get(name)
+            if old is None:
+                continue
+            for field, floor in (('cpu_seconds', min_cpu_seconds), ('peak_rss_kb', min_rss_kb)):
+                if total[field] > old[field] * (1 + tolerance) and total[field] - old[field] > floor:
+                    found.append('{} lines, {}: {} {} -> {}'.format(lines, name, field, old[field], total[field]))
+    return found
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--scales', default='1000,10000')
+    parser.add_argument('--vocab', type=int, default=2000)
+    parser.add_argument('--ambiguity', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--work', default=os.path.join(tempfile.gettempdir(), 'lexlearner-bench'))
+    parser.add_argument('--out')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='config line added for every run, e.g. --set "dedup_pairs = False"')
+    args = parser.parse_args()
+
+    results = {}
+    for lines in map(int, args.scales.split(',')):
+        work = os.path.join(args.work, str(lines))
+        if os.path.exists(work):
+            shutil.rmtree(work)
+        os.makedirs(work)
+        pair_data, corpus_folder = synth.generate(os.path.join(work, 'corpus'), lines, args.vocab,
+                                                  args.ambiguity, seed=args.seed)
+        write_config(work, pair_data, corpus_folder, lines, ['use_stage_cache = False'] + args.set)
+        btime = perf_counter()
+        run_lexlearner(work)
+        wall = perf_counter() - btime
+        with open(os.path.join(work, 'data', 'run-report.json'), 'r', encoding='utf-8') as ifile:
+            totals = stage_totals(json.load(ifile))
+        print_totals(lines, wall, totals)
+        results[str(lines)] = {'wall_seconds': round(wall, 3), 'stages': totals}
+
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as ofile:
+            json.dump({'vocab': args.vocab, 'ambiguity': args.ambiguity, 'seed': args.seed,
+                       'settings': args.set, 'results': results}, ofile, indent=1)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as ifile:
+            found = regressions(results, json.load(ifile)['results'], args.tolerance)
+        for regression in found:
+            print('regression:', regression)
+        sys.exit(1 if found else 0)
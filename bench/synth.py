@@ -0,0 +1,93 @@
+#! /usr/bin/python3
+"""
+Generate a synthetic parallel corpus and stand-in language pair.
+
+Source words are "a<n>", target words "b<n>"; the part of speech of a
+word follows from its number (see tools/standin.py). A fraction of the
+source vocabulary is ambiguous: its translation is picked among several
+target words depending on the following word, so there is something for
+the maximum-entropy rules to learn.
+"""
+
+import argparse, os, random, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tools'))
+from standin import analyse, cats
+
+def make_lexicon(vocab, ambiguity, max_tls, rng):
+    """
+    Return {source id: [target ids]}; alternatives keep the part of speech.
+    """
+    lexicon = {}
+    for n in range(vocab):
+        tls = [n]
+        if rng.random() < ambiguity:
+            for k in range(1, rng.randint(2, max_tls)):
+                tls.append(n + k * vocab * len(cats))
+        lexicon[n] = tls
+    return lexicon
+
+def write_pair(pair_data, source, target, lexicon):
+    """
+    Write the stand-in monodixes, bidix and Makefile of apertium-SOURCE-TARGET.
+    """
+    pair = '{}-{}'.format(source, target)
+    os.makedirs(pair_data, exist_ok=True)
+    with open(os.path.join(pair_data, 'apertium-{0}.{0}.dix'.format(pair)), 'w', encoding='utf-8') as bidix:
+        bidix.write('# {}\n'.format(pair))
+        for n, tls in sorted(lexicon.items()):
+            for m in tls:
+                bidix.write('{}\t{}\n'.format(analyse('a{}'.format(n)), analyse('b{}'.format(m))))
+    for lang, words in ((source, ['a{}'.format(n) for n in lexicon]),
+                        (target, sorted({'b{}'.format(m) for tls in lexicon.values() for m in tls}))):
+        with open(os.path.join(pair_data, 'apertium-{}.{}.dix'.format(pair, lang)), 'w', encoding='utf-8') as dix:
+            for word in words + ['.', ',']:
+                dix.write('{}\t{}\n'.format(word, analyse(word)))
+    with open(os.path.join(pair_data, 'Makefile'), 'w', encoding='utf-8') as makefile:
+        for direction in (pair, '{}-{}'.format(target, source)):
+            makefile.write('{}.autobil.bin: apertium-{}.{}.dix\n\tcp $< $@\n\n'.format(direction, pair, pair))
+
+def write_corpus(corpus_folder, corpus_name, corpus_pair_name, source, target,
+                 lexicon, lines, min_len, max_len, rng):
+    """
+    Write CORPUS.PAIR.SOURCE and CORPUS.PAIR.TARGET, one sentence per line.
+    """
+    os.makedirs(corpus_folder, exist_ok=True)
+    prefix = os.path.join(corpus_folder, '{}.{}'.format(corpus_name, corpus_pair_name))
+    vocab = len(lexicon)
+    with open('{}.{}'.format(prefix, source), 'w', encoding='utf-8') as sfile,\
+         open('{}.{}'.format(prefix, target), 'w', encoding='utf-8') as tfile:
+        for _ in range(lines):
+            words = [rng.randrange(vocab) for _ in range(rng.randint(min_len, max_len))]
+            sl, tl = [], []
+            for i, n in enumerate(words):
+                tls = lexicon[n]
+                context = words[i + 1] if i + 1 < len(words) else 0
+                sl.append('a{}'.format(n))
+                tl.append('b{}'.format(tls[context % len(tls)]))
+            sfile.write(' '.join(sl) + ' .\n')
+            tfile.write(' '.join(tl) + ' .\n')
+
+def generate(root, lines, vocab=2000, ambiguity=0.2, max_tls=3,
+             min_len=4, max_len=30, seed=1, source='en', target='es'):
+    """
+    Generate a pair and corpus under root; return (pair_data, corpus_folder).
+    """
+    rng = random.Random(seed)
+    lexicon = make_lexicon(vocab, ambiguity, max_tls, rng)
+    pair_data = os.path.join(root, 'apertium-{}-{}'.format(source, target))
+    corpus_folder = os.path.join(root, 'corpora')
+    write_pair(pair_data, source, target, lexicon)
+    write_corpus(corpus_folder, 'synthetic', '{}-{}'.format(target, source),
+                 source, target, lexicon, lines, min_len, max_len, rng)
+    return pair_data, corpus_folder
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('root')
+    parser.add_argument('--lines', type=int, default=1000)
+    parser.add_argument('--vocab', type=int, default=2000)
+    parser.add_argument('--ambiguity', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    generate(args.root, args.lines, args.vocab, args.ambiguity, seed=args.seed)
@@ -0,0 +1,23 @@
+"""
+Stand-in for apertium-lex-tools/scripts/common.py (tokenisers only).
+"""
+
+import re
+
+lu_re = re.compile(r'\^(.*?)\$')
+
+def tokenise_tagger_line(line):
+    """
+    '^a<n>$ ^b<adj>$' -> ['a<n>', 'b<adj>']
+    """
+    return [lu.strip() for lu in lu_re.findall(line)]
+
+def tokenise_biltrans_line(line):
+    """
+    '^a<n>/x<n>/y<n>$' -> [{'sl': 'a<n>', 'tls': ['x<n>', 'y<n>']}]
+    """
+    out = []
+    for lu in lu_re.findall(line):
+        parts = lu.split('/')
+        out.append({'sl': parts[0], 'tls': parts[1:]})
+    return out
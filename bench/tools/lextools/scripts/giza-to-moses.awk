@@ -0,0 +1,13 @@
+#!/usr/bin/awk -f
+# Stand-in for apertium-lex-tools/scripts/giza-to-moses.awk:
+# turn GIZA++ A3 triples into "target ||| source ||| " lines.
+NR % 3 == 2 { target = $0 }
+NR % 3 == 0 {
+    source = ""
+    for (i = 1; i <= NF; i++) {
+        if ($i == "NULL" || $i == "({" || $i == "})" || $i ~ /^[0-9]+$/)
+            continue
+        source = source (source == "" ? "" : " ") $i
+    }
+    print target " ||| " source " ||| "
+}
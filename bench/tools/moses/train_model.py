@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the GIZA++/MGIZA steps of Moses train-model.perl.
+
+The synthetic corpora translate word for word, so the "alignment" is the
+monotone diagonal. Steps 1-3 write the giza.*/ A3 files and
+model/aligned.grow-diag-final-and under -root-dir; later steps write an
+empty phrase table so that full runs leave the same artifacts behind.
+"""
+import gzip, os, sys
+
+def parse_args(argv):
+    opts, key = {}, None
+    for arg in argv:
+        if arg.startswith('-') and not arg[1:2].isdigit():
+            key = arg.lstrip('-')
+            opts[key] = True
+        elif key is not None:
+            opts[key] = arg
+            key = None
+    return opts
+
+def write_a3(fname, target_lines, source_lines):
+    with gzip.open(fname, 'wt', encoding='utf-8') as a3:
+        for n, (tl, sl) in enumerate(zip(target_lines, source_lines), 1):
+            tl_words, sl_words = tl.split(), sl.split()
+            a3.write('# Sentence pair ({}) source length {} target length {} alignment score : 1\n'.format(
+                n, len(sl_words), len(tl_words)))
+            a3.write(' '.join(tl_words) + '\n')
+            links = ['NULL ({ })']
+            for i, word in enumerate(sl_words, 1):
+                links.append('{} ({{ {} }})'.format(word, i if i <= len(tl_words) else ''))
+            a3.write(' '.join(links) + '\n')
+
+if __name__ == '__main__':
+    opts = parse_args(sys.argv[1:])
+    root = opts.get('root-dir', '.')
+    f, e = opts['f'], opts['e']
+    first, last = int(opts.get('first-step', 1)), int(opts.get('last-step', 9))
+    with open('{}.{}'.format(opts['corpus'], f), 'r', encoding='utf-8') as ffile:
+        f_lines = ffile.read().splitlines()
+    with open('{}.{}'.format(opts['corpus'], e), 'r', encoding='utf-8') as efile:
+        e_lines = efile.read().splitlines()
+    if first <= 2 <= last:
+        for src, tgt, s_lines, t_lines in ((f, e, f_lines, e_lines), (e, f, e_lines, f_lines)):
+            giza_dir = os.path.join(root, 'giza.{}-{}'.format(tgt, src))
+            os.makedirs(giza_dir, exist_ok=True)
+            write_a3(os.path.join(giza_dir, '{}-{}.A3.final.gz'.format(tgt, src)), s_lines, t_lines)
+    if first <= 3 <= last:
+        os.makedirs(os.path.join(root, 'model'), exist_ok=True)
+        with open(os.path.join(root, 'model', 'aligned.grow-diag-final-and'), 'w', encoding='utf-8') as afile:
+            for fl, el in zip(f_lines, e_lines):
+                n = min(len(fl.split()), len(el.split()))
+                afile.write(' '.join('{0}-{0}'.format(i) for i in range(n)) + '\n')
+    if last > 3:
+        open(os.path.join(root, 'model', 'phrase-table.gz'), 'wb').close()
@@ -0,0 +1,98 @@
+"""
+Shared helpers for the stand-in Apertium/lex-tools/Moses programs.
+
+The stand-ins understand the synthetic dictionaries written by
+bench/synth.py: every "binary" is a plain-text copy of the .dix it was
+"compiled" from, and monolingual analyses are derived from the surface
+form itself, so no real transducer is needed.
+"""
+
+import os, re, sys
+
+cats = ('n', 'vblex', 'adj', 'det', 'pr', 'adv')
+cat_tags = {'n': '<n><sg>', 'vblex': '<vblex><pres>', 'adj': '<adj>',
+            'det': '<det><def><sp>', 'pr': '<pr>', 'adv': '<adv>'}
+punct_tags = {'.': '<sent>', ',': '<cm>', '-': '<guio>'}
+
+lu_re = re.compile(r'\^(.*?)\$')
+
+def analyse(word):
+    """
+    Analyse a synthetic surface form such as "a17" into "a17<adj>".
+    """
+    if word in punct_tags:
+        return word + punct_tags[word]
+    digits = word.lstrip('ab')
+    if not digits.isdigit():
+        return '*' + word
+    return word + cat_tags[cats[int(digits) % len(cats)]]
+
+def split_lu(lu):
+    """
+    Split "a17<det><def>" into ('a17', '<det><def>').
+    """
+    pos = lu.find('<')
+    if pos < 0:
+        return lu, ''
+    return lu[:pos], lu[pos:]
+
+def read_bidix(fname, direction):
+    """
+    Read a stand-in bilingual dictionary ("# src-tgt" header followed by
+    "sl<tags>\ttl<tags>" lines) into {sl: [tl, ...]} for the given direction.
+    """
+    entries = {}
+    with open(fname, 'r', encoding='utf-8') as bidix:
+        header = bidix.readline().strip('# \n')
+        reverse = header != direction
+        for line in bidix:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) != 2:
+                continue
+            sl, tl = (parts[1], parts[0]) if reverse else parts
+            entries.setdefault(sl, []).append(tl)
+    return entries
+
+def direction_of(fname):
+    """
+    "/path/en-es.autobil.bin" -> "en-es"
+    """
+    return os.path.basename(fname).split('.')[0]
+
+def stream(process, null_flush):
+    """
+    Feed stdin to process() line by line, or chunk by chunk in null-flush mode.
+    process() takes a str and returns a str.
+    """
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    if not null_flush:
+        for line in stdin:
+            stdout.write(process(line.decode('utf-8')).encode('utf-8'))
+        stdout.flush()
+        return
+    buf = b''
+    while True:
+        data = stdin.read1(65536)
+        if not data:
+            break
+        buf += data
+        while b'\0' in buf:
+            chunk, buf = buf.split(b'\0', 1)
+            stdout.write(process(chunk.decode('utf-8')).encode('utf-8') + b'\0')
+            stdout.flush()
+    if buf:
+        stdout.write(process(buf.decode('utf-8')).encode('utf-8'))
+        stdout.flush()
+
+def parse_flags(argv):
+    """
+    Split argv into a set of single-letter flags and a list of positional arguments.
+    """
+    flags, args = set(), []
+    for arg in argv:
+        if arg.startswith('-') and len(arg) > 1:
+            flags.update(arg[1:])
+        else:
+            args.append(arg)
+    return flags, args
@@ -1,142 +1,235 @@
 #! /usr/bin/python3
 
-import os, sys, re, pipes
-from subprocess import call
-from time import clock
+import os, sys, re, io, json, pipes, shutil, tempfile, hashlib, itertools
+from subprocess import check_call, Popen, PIPE, CalledProcessError
+from collections import deque, OrderedDict
+from functools import lru_cache
+from array import array
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from time import perf_counter
 from llconfig import *
+from llpool import get_pool
+from llcache import StageCache, make_key, hash_pair_data, file_stamp, read_progress, write_progress, clear_progress
+from llcount import Vocab, PairCounts, EventSpill, FeatureNumbers, HashedFeatures, ExternalSorter
+from llshard import write_shard, read_shard_info, read_shard_counts, read_shard_events, check_shards
+from llformat import split_defaults, TokensWriter, read_tokens_words, read_tokens
+from llreport import report, stage, add_inputs, add_lines, file_lines
+from lldag import StageGraph
+import llfile
+from llfile import open_file
+from llcorpus import CorpusFile, select_lines, hash_selection
+from llevents import EventWriter, read_words, scan_events, read_events, hash_events, yasmet_line
 sys.path.insert(0, os.path.join(lextools, 'scripts'))
 import common
 
+# tokenised lines seen recently, as corpora repeat many sentences and phrases;
+# the tokens are shared by all callers, which must not modify them
+tokenise_tagger_line = lru_cache(maxsize=tokenise_cache_size)(common.tokenise_tagger_line)
+tokenise_biltrans_line = lru_cache(maxsize=tokenise_cache_size)(common.tokenise_biltrans_line)
+
 after_end_re = re.compile(r'\$.*?\^')
+space_re = re.compile('[ \t\n\r\f\v]+')
 punct_tag_re = re.compile('<(guio|sent|cm)>')
 open_cats_re = re.compile('<{}>'.format('>|<'.join(opencats)))
 
-lm_fname = "/tmp/test.lm"
+pool = get_pool(pool_workers, pool_batch_lines)
+cache = StageCache(data_folder, use_stage_cache)
+llfile.configure(io_buffer_size, compression_level)
+# set by --resume: reuse the stages and the progress of a run that stopped
+resume = False
 
-def tag_corpus(pair_data, source, target,
-               pair_name, corpus_folder,
-               corpus_name, data_folder):
+def compressed(fname):
     """
-    Translate corpus up until pretransfer stage
+    Name of an intermediate file only read by lexlearner, compressed as configured.
     """
-    # create partial translation pipeline
-    pipe = pipes.Template()
-    pipe.append('apertium -d "{}" {}-{}-tagger'.format(pair_data, source, target), '--')
-    pipe.append('apertium-pretransfer', '--')
+    return llfile.compressed_fname(fname, compression)
 
-    # file names
+def corpus_fnames(source, pair_name, corpus_folder, corpus_name, data_folder):
+    """
+    Names of the raw corpus file and of its tagged version for one language.
+    """
     corpus_prefix = os.path.join(corpus_folder, corpus_name)
     ifname = os.path.join(corpus_folder,
                           '{}.{}.{}'.format(corpus_prefix, pair_name, source))
-    ofname = os.path.join(data_folder, 
-                          '{}.{}.tagged.{}'.format(corpus_name, pair_name, source))
-    
-    # translation
-    linecount = 0
-    with open(ifname, 'r', encoding='utf-8') as ifile,\
-         pipe.open(ofname, 'w') as pipefile:
-        for line in ifile:
-            pipefile.write(line)
-            linecount += 1
-            if linecount == maxlines:
-                break
-    return linecount, ofname
+    ofname = compressed(os.path.join(data_folder,
+                                     '{}.{}.tagged.{}'.format(corpus_name, pair_name, source)))
+    return ifname, ofname
 
-def clean_tags(pair_name, sfname, tfname, source, target, corpus_name, data_folder):
+@lru_cache(maxsize=None)
+def open_corpus(ifname):
     """
-    Clean up and convert tags simultaneously in both corpora to be used in MGIZA
+    The indexed corpus file ifname; its line index is kept in data_folder.
     """
-    with open(sfname, 'r', encoding='utf-8') as sfile, \
-         open(tfname, 'r', encoding='utf-8') as tfile, \
-         open(sfname.replace('tagged', 'retagged'), 'w', encoding='utf-8') as sfile_re,\
-         open(tfname.replace('tagged', 'retagged'), 'w', encoding='utf-8') as tfile_re:
-        for sline, tline in zip(sfile, tfile):
-            if '<' in sline + tline:
-                sfile_re.write(after_end_re.sub('$ ^', sline.replace(' ', '~')))
-                tfile_re.write(after_end_re.sub('$ ^', tline.replace(' ', '~')))
+    return CorpusFile(ifname, os.path.join(data_folder, os.path.basename(ifname) + '.index'))
 
-    ifname_prefix = os.path.join(data_folder, '{}.{}.retagged'.format(corpus_name, pair_name))
-    ofname_prefix = os.path.join(data_folder, '{}.{}.tagged-clean'.format(corpus_name, pair_name))
+def corpus_lines(corpus, start=None):
+    """
+    Numbers of the corpus lines to learn from: maxlines lines from line corpus_start on,
+    drawn at random with corpus_sample_seed if it is set; or, from line start on,
+    the next maxlines lines.
+    """
+    if start is None:
+        return select_lines(len(corpus), corpus_start, maxlines, corpus_sample_seed)
+    return select_lines(len(corpus), start, maxlines)
 
-    call(['perl', os.path.join(moses, 'clean-corpus-n.perl'), ifname_prefix,
-          source, target, ofname_prefix, '1', '40'])
+def tagger_command(pair_data, source, target):
+    """
+    Partial translation pipeline up until pretransfer stage.
+    """
+    return 'apertium -z -d "{}" {}-{}-tagger | apertium-pretransfer -z'.format(pair_data, source, target)
 
-    return '{}.{}'.format(ofname_prefix, source), '{}.{}'.format(ofname_prefix, target)
+def multitrans_command(bin_fname, flags):
+    """
+    multitrans call on a given transducer in null-flush mode.
+    """
+    return '{} {} {} -z'.format(os.path.join(lextools, 'multitrans'), bin_fname, flags)
 
-def trim_tags(pair_data, source, target, lextools, ifname):
+@stage
+def tag_corpus(pair_data, source, target,
+               pair_name, corpus_folder,
+               corpus_name, data_folder, jobs=tagger_jobs, start=None):
     """
-    Trim individual tag sets to fit into some coarse-grained classes.
+    Translate the selected corpus lines (see corpus_lines) up until pretransfer stage
     """
-    pipe = pipes.Template()
-    pipe.append('{} {}.autobil.bin -p -t'.format(os.path.join(lextools, 'multitrans'),
-                                                 os.path.join(pair_data, '{}-{}'.format(source, target))), '--')
-    ofname = ifname.replace('tagged-clean', 'trimmed')
+    ifname, ofname = corpus_fnames(source, pair_name, corpus_folder, corpus_name, data_folder)
+    add_inputs(ifname)
+    command = tagger_command(pair_data, source, target)
+    corpus = open_corpus(ifname)
+    numbers = corpus_lines(corpus, start)
+    key = make_key('tag_corpus', command, file_stamp(ifname), start, corpus_start, maxlines, corpus_sample_seed)
+    linecount = pool.copy_lines(command, lambda skip: corpus.lines(numbers[skip:]), ofname, key,
+                                workers=jobs, checkpoint=checkpoint_lines, resume=resume)
+    add_lines(len(numbers), linecount)
+    return linecount, ofname
+
+def tag_corpora(pair_data, source, target,
+                pair_name, corpus_folder,
+                corpus_name, data_folder, jobs=tagger_jobs, start=None):
+    """
+    Translate both sides of the corpus up until pretransfer stage at once.
+    Each side is sent in batches to up to jobs warm tagger processes
+    and written back in order, so the tagged files stay parallel.
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(tag_corpus, pair_data, sl, tl, pair_name,
+                                   corpus_folder, corpus_name, data_folder, jobs, start)
+                   for sl, tl in ((source, target), (target, source))]
+        return [future.result() for future in futures]
 
-    pipe.copy(ifname, ofname)
+def split_words(line):
+    """
+    Words of a line split at ASCII whitespace, as Perl splits bytes at \s.
+    """
+    if line.isascii():
+        return line.split()
+    return [word for word in space_re.split(line) if word]
 
-    #with open(ifname, 'r', encoding='utf-8') as ifile,\
-    #     pipe.open(ofname, 'w') as pipefile:
-    #    for line in ifile:
-    #        pipefile.write(line)
+def clean_pair(sline, tline):
+    """
+    Convert the tags of a pair of tagged lines for MGIZA and filter the pair
+    the way clean-corpus-n.perl does. Return the cleaned lines, or the
+    reason the pair is dropped.
+    """
+    if '<' not in sline and '<' not in tline:
+        return 'untagged'
+    swords = split_words(after_end_re.sub('$ ^', sline.replace(' ', '~')).replace('|', ''))
+    twords = split_words(after_end_re.sub('$ ^', tline.replace(' ', '~')).replace('|', ''))
+    if not swords or not twords:
+        return 'empty'
+    if len(swords) > clean_max_words or len(twords) > clean_max_words:
+        return 'too long'
+    if len(swords) < clean_min_words or len(twords) < clean_min_words:
+        return 'too short'
+    if len(swords) / len(twords) > clean_max_ratio or len(twords) / len(swords) > clean_max_ratio:
+        return 'length ratio'
+    return ' '.join(swords) + '\n', ' '.join(twords) + '\n'
+
+def clean_chunk(pairs):
+    """
+    Clean a chunk of line pairs; return the pairs kept and the number dropped for every reason.
+    """
+    kept, dropped = [], {}
+    for sline, tline in pairs:
+        cleaned = clean_pair(sline, tline)
+        if isinstance(cleaned, str):
+            dropped[cleaned] = dropped.get(cleaned, 0) + 1
+        else:
+            kept.append(cleaned)
+    return kept, dropped
+
+@stage
+def clean_tags(pair_name, sfname, tfname, source, target, corpus_name, data_folder):
+    """
+    Clean up and convert tags simultaneously in both corpora to be used in MGIZA,
+    keeping the pairs clean-corpus-n.perl would keep, in one pass: chunks of
+    pairs are cleaned on up to clean_jobs processes and written back in order.
+    """
+    ofname_prefix = os.path.join(data_folder, '{}.{}.tagged-clean'.format(corpus_name, pair_name))
+    sofname = compressed('{}.{}'.format(ofname_prefix, source))
+    tofname = compressed('{}.{}'.format(ofname_prefix, target))
+
+    def chunks(sfile, tfile):
+        pairs = zip(sfile, tfile)
+        chunk = list(itertools.islice(pairs, clean_chunk_lines))
+        while chunk:
+            yield chunk
+            chunk = list(itertools.islice(pairs, clean_chunk_lines))
+
+    total, dropped = 0, {}
+    def write(result):
+        nonlocal total
+        kept, chunk_dropped = result
+        for sline, tline in kept:
+            sofile.write(sline)
+            tofile.write(tline)
+        total += len(kept)
+        for reason, count in chunk_dropped.items():
+            dropped[reason] = dropped.get(reason, 0) + count
+
+    in_flight = deque()
+    with open_file(sfname, 'r') as sfile, \
+         open_file(tfname, 'r') as tfile, \
+         open_file(sofname, 'w') as sofile, \
+         open_file(tofname, 'w') as tofile, \
+         ProcessPoolExecutor(max_workers=clean_jobs) as executor:
+        for chunk in chunks(sfile, tfile):
+            in_flight.append(executor.submit(clean_chunk, chunk))
+            if len(in_flight) > clean_jobs:
+                write(in_flight.popleft().result())
+        while in_flight:
+            write(in_flight.popleft().result())
+
+    kept = total
+    total += sum(dropped.values())
+    add_lines(total, kept)
+    print('pairs: {}, kept: {}, {}'.format(total, kept, ', '.join('{}: {}'.format(reason, dropped.get(reason, 0))
+                                                                for reason in ('untagged', 'empty', 'too long', 'too short', 'length ratio'))),
+          file=sys.stderr)
+    return sofname, tofname
+
+@stage
+def trim_tags(pair_data, source, target, lextools, ifname):
+    """
+    Trim individual tag sets to fit into some coarse-grained classes.
+    """
+    command = multitrans_command(os.path.join(pair_data, '{}-{}.autobil.bin'.format(source, target)), '-p -t')
+    ofname = llfile.plain_fname(ifname).replace('tagged-clean', 'trimmed')
+    if dedup_pairs:
+        # only read by dedup_corpus, otherwise aligned by moses
+        ofname = compressed(ofname)
+    linecount = pool.copy(command, ifname, ofname, checkpoint=checkpoint_lines, resume=resume)
+    add_lines(linecount, linecount)
     return ofname
 
-def get_default(line):
-    lemma_tl = '';
-    tags_tl = '';
-    lemma_sl = '';
-    tags_sl = '';
-    state = 0;
-    escaped = False;
-    for c in line: #{
-        if c == '^': #{
-            state = 1; 
-            continue;
-        #}
-        if c == '\\': #{
-            escaped = True;
-            continue;
-        #}
-        if c == '<': #{
-            if state == 1: #{
-                state = 2; 
-            #}
-            if state == 3: #{
-                state = 4;
-            #}
-            continue;
-        #}
-        if c == '/' and state == 2 and not escaped: #{
-            state = 3    
-            continue;
-        #}
-        if c == '$' or (c == '/' and state > 2) and not escaped: #{
-            break;
-        #}
-
-        if state == 1: #{
-            lemma_sl = lemma_sl + c;
-        elif state == 2: #{    
-            if c == '>': #{
-                tags_sl = tags_sl + '.'    
-            elif c != '<': #{
-                tags_sl = tags_sl + c;
-            #}
-                
-        elif state == 3: #{
-            lemma_tl = lemma_tl + c;    
-        elif state == 4: #{
-            if c == '>': #{
-                tags_tl = tags_tl + '.'    
-            elif c != '<': #{
-                tags_tl = tags_tl + c;
-            #}
-        #}
-    #}    
-    tags_sl = tags_sl.strip('.');
-    tags_tl = tags_tl.strip('.');
-
-    return (lemma_sl, tags_sl, lemma_tl, tags_tl)
+@stage
+def make_autobil(pair_data, source, target):
+    """
+    Build the source-target bilingual transducer, read by trim_tags and prepare_data.
+    """
+    check_call(['make', '{}-{}.autobil.bin'.format(source, target)], cwd=pair_data)
+    return os.path.join(pair_data, '{}-{}.autobil.bin'.format(source, target))
 
+@stage
 def prepare_data(pair_data, source, target, pair_name, data_folder):
     """
     Make rules for the words that must be translated unambiguously
@@ -145,123 +238,376 @@ def prepare_data(pair_data, source, target, pair_name, data_folder):
     autobil_ambig = os.path.join(pair_data, '{}-{}.autobil.ambig.bin'.format(source, target))
     autobil_unambig = os.path.join(pair_data, '{}-{}.autobil.bin'.format(source, target))
 
-    call(['lt-comp', 'lr', os.path.join(pair_data, 'apertium-{}.{}.dix'.format(pair_name, pair_name)), autobil_ambig])
-
-    cwdir = os.getcwd()
-    os.chdir(pair_data)
-    call(['make', '{}-{}.autobil.bin'.format(source, target)])
-    os.chdir(cwdir)
+    bidix_direction = 'lr' if pair_name.startswith(source + '-') else 'rl'
+    check_call(['lt-comp', bidix_direction, os.path.join(pair_data, 'apertium-{}.{}.dix'.format(pair_name, pair_name)), autobil_ambig])
 
-    if os.path.exists(os.path.join(pair_data, '.deps', 'en.dix')):
-        dict_name = os.path.join(pair_data, '.deps', 'en.dix')
+    if os.path.exists(os.path.join(pair_data, '.deps', '{}.dix'.format(source))):
+        dict_name = os.path.join(pair_data, '.deps', '{}.dix'.format(source))
     else:
         dict_name = os.path.join(pair_data, 'apertium-{}.{}.dix'.format(pair_name, source))
+    add_inputs(dict_name)
 
-    ambig_pipe = pipes.Template()
-    ambig_pipe.append('{} {} -b -t'.format(os.path.join(lextools, 'multitrans'), autobil_ambig), '--')
-    ambig_pipefname = os.path.join(data_folder, 'ambig')
+    ambig_command = multitrans_command(autobil_ambig, '-b -t')
+    unambig_command = multitrans_command(autobil_unambig, '-b -t')
 
-    unambig_pipe = pipes.Template()
-    unambig_pipe.append('{} {} -b -t'.format(os.path.join(lextools, 'multitrans'), autobil_unambig), '--')
-    unambig_pipefname = os.path.join(data_folder, 'unambig')
-
-    exp_dict_fname = os.path.join(data_folder, 'expanded')
-    call(['lt-expand', dict_name, exp_dict_fname])
-    with open(exp_dict_fname, 'r', encoding='utf-8') as exp_dict_file, \
-         ambig_pipe.open(ambig_pipefname, 'w') as ambig_pipefile, \
-         unambig_pipe.open(unambig_pipefname, 'w') as unambig_pipefile:
-        for line in exp_dict_file:
+    nunits = [0]
+    def expanded_units(expanded):
+        # the same analysis comes with every surface form it has:
+        # units seen among the last expand_window ones are not translated again
+        recent = OrderedDict()
+        for line in expanded:
             if 'REGEXP' not in line:
                 line = line.strip().replace(':>:', ':').replace(':<:', ':')
-                line = '^{}$\n'.format(line.split(':')[1])
-                ambig_pipefile.write(line)
-                unambig_pipefile.write(line)
-
-    rules = set()
-    with open(ambig_pipefname, 'r', encoding='utf-8') as ambig_pipefile, \
-         open(unambig_pipefname, 'r', encoding='utf-8') as unambig_pipefile:
-        for ambig_line, unambig_line in zip(ambig_pipefile, unambig_pipefile):
+                unit = '^{}$'.format(line.split(':')[1])
+                if unit in recent:
+                    recent.move_to_end(unit)
+                    continue
+                recent[unit] = None
+                if len(recent) > expand_window:
+                    recent.popitem(last=False)
+                nunits[0] += 1
+                yield unit
+
+    def combined_lines(ambig_lines, unambig_lines):
+        for ambig_line, unambig_line in zip(ambig_lines, unambig_lines):
             combined_line = '{}\t{}'.format(ambig_line.strip(), unambig_line.strip())
             if combined_line.count('/') >= 3 and open_cats_re.search(combined_line) is None:
-                rules.add(get_default(combined_line))
+                yield combined_line
+
+    # lt-expand output goes through both translators at once, nothing is written
+    # to disk but the rules, which are sorted within their own memory budget
+    rules = ExternalSorter(defaults_sort_budget(), key=lambda rule: (rule[0].lower(), rule), unique=True, tmp_dir=data_folder)
+    expand = Popen(['lt-expand', dict_name], stdout=PIPE)
+    with io.TextIOWrapper(expand.stdout, encoding='utf-8') as expanded:
+        ambig_units, unambig_units = itertools.tee(expanded_units(expanded))
+        for rule in split_defaults(combined_lines(pool.map(ambig_command, ambig_units),
+                                                  pool.map(unambig_command, unambig_units))):
+            rules.add(rule)
+    if expand.wait():
+        raise CalledProcessError(expand.returncode, expand.args)
 
-    rules = list(rules)
-    rules.sort(key=lambda x: x[0].lower())   
     gdeffname = os.path.join(data_folder, 'global-defaults.{}-{}.lrx'.format(source, target))
     with open(gdeffname, 'w', encoding='utf-8') as gdeffile:
         gdeffile.write('<rules>\n')
+        nrules = 0
         for rule in rules:
+            nrules += 1
             gdeffile.write('  <rule><match lemma="{}" tags="{}"><select lemma="{}" tags="{}"/></match></rule>\n'.format(*rule))
         gdeffile.write('</rules>')
+    rules.close()
+    add_lines(nunits[0], nrules)
 
-    call(['lrx-comp', gdeffname, os.path.join(data_folder, 'global-defaults.{}-{}.bin'.format(source, target))])
+    gdefbinfname = os.path.join(data_folder, 'global-defaults.{}-{}.bin'.format(source, target))
+    check_call(['lrx-comp', gdeffname, gdefbinfname])
+    return gdefbinfname
 
 def is_ambiguous(bt):
     return any(len(token['tls']) > 1 for token in bt)
 
-def align_corpus(pair_data, source, target, pair_name, corpus_name, data_folder):
+def clean_biltrans_command(pair_data, source, target, gdefbinfname):
+    """
+    Biltrans of the source side with the global defaults applied,
+    leaving only the ambiguities that rules are learnt for.
+    """
+    pair = '{}-{}'.format(source, target)
+    return '{} | lrx-proc -m -z {}'.format(multitrans_command(os.path.join(pair_data, '{}.autobil.bin'.format(pair)), '-b'),
+                                           gdefbinfname)
+
+@stage
+def dedup_corpus(pair_data, source, target, pair_name, sfname, tfname, corpus_name, data_folder, gdefbinfname=None,
+                 reverse_gdefbinfname=None):
+    """
+    Keep one copy of every trimmed sentence pair, and only the pairs with an
+    ambiguous source word left after the global defaults, so that MGIZA aligns
+    no more than is needed. The line numbers of all copies of every pair kept
+    go to a '.lines' file, one pair per line, and its source biltrans to a
+    '.biltrans' file, both parallel to the deduplicated corpus.
+    With reverse_gdefbinfname, the global defaults of target-source, pairs
+    with an ambiguous target word are kept as well, and the target biltrans
+    goes to a '.biltrans' file of its own, so that one alignment serves both ways.
+    """
+    pair = '{}-{}'.format(source, target)
+    gdefbinfname = gdefbinfname or os.path.join(data_folder, 'global-defaults.{}.bin'.format(pair))
+    ofname_prefix = os.path.join(data_folder, '{}.{}.unique'.format(corpus_name, pair_name))
+    sofname, tofname = '{}.{}'.format(ofname_prefix, source), '{}.{}'.format(ofname_prefix, target)
+    bt_fname, lines_fname = compressed('{}.{}.biltrans'.format(ofname_prefix, pair)), compressed(ofname_prefix + '.lines')
+    reverse_bt_fname = reverse_gdefbinfname and compressed('{}.{}-{}.biltrans'.format(ofname_prefix, target, source))
+
+    first = {} # first[hash of the pair] = number of the pair among unique pairs
+    copies = [] # copies[number of the pair] = [line numbers]
+    rows = deque()
+    def unique_lines(sfile, tfile):
+        for lineno, (sline, tline) in enumerate(zip(sfile, tfile), 1):
+            key = hashlib.blake2b('{}\0{}'.format(sline, tline).encode('utf-8'), digest_size=16).digest()
+            number = first.get(key)
+            if number is not None:
+                copies[number].append(lineno)
+                continue
+            first[key] = len(copies)
+            copies.append([lineno])
+            rows.append((sline, tline, len(copies) - 1))
+            yield sline.replace('~', ' '), tline.replace('~', ' ')
+
+    def biltrans_lines(unique):
+        # one tuple of biltrans lines for every unique pair, both ways at once
+        command = clean_biltrans_command(pair_data, source, target, gdefbinfname)
+        if reverse_gdefbinfname is None:
+            return zip(pool.map(command, (sline for sline, tline in unique)))
+        reverse_command = clean_biltrans_command(pair_data, target, source, reverse_gdefbinfname)
+        sunique, tunique = itertools.tee(unique)
+        return zip(pool.map(command, (sline for sline, tline in sunique)),
+                   pool.map(reverse_command, (tline for sline, tline in tunique)))
+
+    kept = []
+    with open_file(sfname, 'r') as sfile, \
+         open_file(tfname, 'r') as tfile, \
+         open_file(sofname, 'w') as sofile, \
+         open_file(tofname, 'w') as tofile, \
+         open_file(bt_fname, 'w') as bt_file:
+        bt_files = [bt_file]
+        if reverse_bt_fname:
+            bt_files.append(open_file(reverse_bt_fname, 'w'))
+        for bt_row in biltrans_lines(unique_lines(sfile, tfile)):
+            sline, tline, number = rows.popleft()
+            bt_row = [bt_line.strip() for bt_line in bt_row]
+            if not any(is_ambiguous(tokenise_biltrans_line(bt_line)) for bt_line in bt_row):
+                continue
+            sofile.write(sline)
+            tofile.write(tline)
+            for bt_line, bt_rfile in zip(bt_row, bt_files):
+                bt_rfile.write(bt_line + '\n')
+            kept.append(number)
+        for bt_rfile in bt_files[1:]:
+            bt_rfile.close()
+
+    with open_file(lines_fname, 'w') as lines_file:
+        for number in kept:
+            lines_file.write(' '.join(map(str, copies[number])) + '\n')
+    add_lines(sum(map(len, copies)), len(kept))
+    print('pairs: {}, unique: {}, with ambiguous words: {}'.format(sum(map(len, copies)), len(copies), len(kept)),
+          file=sys.stderr)
+    return sofname, tofname, bt_fname, lines_fname, reverse_bt_fname
+
+@stage
+def align_corpus(pair_data, source, target, pair_name, corpus_name, data_folder, kind='trimmed'):
     """
     Exactly what it says on the tin.
+    Moses is run one training step at a time, and every step done is
+    recorded, so that with resume alignment goes on from the next step.
+    Return the giza A3 file and the symmetrized alignments.
     """
-    # fake language model
-    open(lm_fname, 'w', encoding='utf-8').write('1\n2\n3')
+    # align corpus; everything moses writes goes to data_folder
+    ifname_prefix = os.path.join(data_folder, '{}.{}.{}'.format(corpus_name, pair_name, kind))
+    corpus_fnames = ['{}.{}'.format(ifname_prefix, lang) for lang in (source, target)]
+    add_inputs(*corpus_fnames)
+    add_lines(file_lines(corpus_fnames[0]) or 0)
+    args = ['perl', os.path.join(moses, 'train-model.perl'),
+            '-root-dir', data_folder,
+            '-mgiza', '-mgiza-cpus', str(mgiza_cpus), '-external-bin-dir', giza, 
+            '-corpus', ifname_prefix, '-f', target, '-e', source,
+            '-alignment', 'grow-diag-final-and']
+    if alignment_only:
+        # stop after symmetrization: phrase extraction, scoring
+        # and reordering model are never read
+        last_step = 3
+    else:
+        last_step = 9
+        # fake language model
+        lm_fname = os.path.join(data_folder, 'fake.lm')
+        open(lm_fname, 'w', encoding='utf-8').write('1\n2\n3')
+        args.extend(['-reordering', 'msd-bidirectional-fe', 
+                     '-lm', '0:5:{}:0'.format(lm_fname)])
+
+    progress_fname = os.path.join(data_folder, 'align_corpus')
+    key = make_key('align_corpus', args, *map(file_stamp, corpus_fnames))
+    first_step = ((resume and read_progress(progress_fname, key)) or {'step': 0})['step'] + 1
+    for step in range(first_step, last_step + 1):
+        check_call(args + ['-first-step', str(step), '-last-step', str(step)])
+        write_progress(progress_fname, key, {'step': step})
+    clear_progress(progress_fname)
+
+    alignments_fname = os.path.join(data_folder, 'model', 'aligned.grow-diag-final-and')
+    return giza_final_fname(data_folder, source, target), alignments_fname
+
+def giza_final_fname(data_folder, source, target):
+    """
+    The giza A3 file of source-target; align_corpus writes those of both directions.
+    """
+    pair = '{}-{}'.format(source, target)
+    return os.path.join(data_folder, 'giza.{}'.format(pair), '{}.A3.final.gz'.format(pair))
+
+def invert_alignment(alignment):
+    """
+    Turn the 'tl-sl' points of an alignment line of target-source into
+    those of source-target, in order.
+    """
+    points = sorted((int(sl), int(tl)) for tl, sl in (point.split('-') for point in alignment.split()))
+    return ' '.join('{}-{}'.format(*point) for point in points) + '\n'
 
-    # align corpus
-    ifname_prefix = os.path.join(data_folder, '{}.{}.trimmed'.format(corpus_name, pair_name))
-    call(['perl', os.path.join(moses, 'train-model.perl'),
-          '-mgiza', '-external-bin-dir', giza, 
-          '-corpus', ifname_prefix, '-f', target, '-e', source,
-          '-alignment', 'grow-diag-final-and', '-reordering', 'msd-bidirectional-fe', 
-          '-lm', '0:5:{}:0'.format(lm_fname)])
+def index_alignments(al_row):
+    """
+    Parse 'tl-sl' alignment points once into {sl index: [tl indices]},
+    keeping the order of the points.
+    """
+    al_index = {}
+    for al in al_row:
+        if al:
+            al_tl, al_sl = al.split('-')
+            al_index.setdefault(int(al_sl), []).append(int(al_tl))
+    return al_index
+
+def aligned_words(sl_row, bt_row, tl_row, al_index):
+    """
+    Yield (i, slword, tlword) for every ambiguous source word
+    and each target word it is aligned to.
+    """
+    for i, (slword, btword) in enumerate(zip(sl_row, bt_row)):
+        if len(btword['tls']) > 1:
+            for al_tl in al_index.get(i, ()):
+                yield i, slword, tl_row[al_tl]
+
+def get_features(sl_ids, i, ngrams):
+    """
+    Ids of the n-grams around the i-th source word, in order of first appearance.
+    N-grams are tuples of word ids, interned in ngrams, or returned as they are if ngrams is None.
+    """
+    features = {}
+    for j in range(1, max_ngrams):
+        pregram = tuple(sl_ids[i-j:i+1])
+        postgram = tuple(sl_ids[i:i+j+1])
+        roundgram = tuple(sl_ids[i-j:i+j+1])
+        for ngram in (pregram, postgram, roundgram):
+            features.setdefault(ngram, None)
+    if ngrams is None:
+        return tuple(features)
+    return ngrams.intern_all(features)
+
+def sentence_events(sl_ids, bt_row, tl_ids, al_index, ngrams, weight):
+    """
+    Yield (slword id, tlword id, n-gram ids, count) maxent events for one sentence seen weight times.
+    """
+    for i, sl_id, tl_id in aligned_words(sl_ids, bt_row, tl_ids, al_index):
+        yield sl_id, tl_id, get_features(sl_ids, i, ngrams), weight
+
+def count_budget():
+    """
+    Entries each counting table may hold within count_memory_mb, None for no limit.
+    """
+    if count_memory_mb is None:
+        return None
+    # two tables (pair counts and n-grams) at about 256 bytes an entry
+    return max(count_memory_mb * 2**20 // 512, 1)
+
+def defaults_sort_budget():
+    """
+    Rules the global-defaults sort may hold within defaults_sort_memory_mb, None for no limit.
+    """
+    if defaults_sort_memory_mb is None:
+        return None
+    # four short strings a rule at about 512 bytes
+    return max(defaults_sort_memory_mb * 2**20 // 512, 1)
+
+def count_tables(vocab, tmp_dir):
+    """
+    Pair counts, event list, n-gram vocabulary and feature numbering for one counting pass.
+    Past the memory budget, counts and events spill to disk and features are numbered
+    by n-gram hashes instead of an in-memory table.
+    """
+    budget = count_budget()
+    if budget is None:
+        ngrams = Vocab()
+        return PairCounts(), [], ngrams, FeatureNumbers(vocab, ngrams)
+    return (PairCounts(budget, tmp_dir), EventSpill(tmp_dir), None,
+            HashedFeatures(vocab, budget, tmp_dir))
+
+def write_freq_lex_file(sl_tl, vocab, freq_lex_fname):
+    """
+    Write frequency lexicon, most frequent translation first and marked with @.
+    """
+    with open(freq_lex_fname, 'w', encoding='utf-8') as freq_lex_file:
+        for sl_id, tl_freqs in sl_tl.groups():
+            sl = vocab[sl_id]
+            first_tag_sl = sl.split('<')[1].split('>')[0].strip()
+            tl_sorted = sorted(tl_freqs, key=lambda x: x[1], reverse=True)
+            first = True
+            for tl_id, freq in tl_sorted:
+                tl = vocab[tl_id]
+                if tl.startswith('*'):
+                    print('tl word "{}" is unknown'.format(tl),  file=sys.stderr)
+                    continue
+                first_tag_tl = tl.split('<')[1].split('>')[0].strip()
+                if first_tag_sl != first_tag_tl:
+                    print('{} != {}'.format(first_tag_sl, first_tag_tl), file=sys.stderr)
+                    continue
+                if first:
+                    freq_lex_file.write('{} ^{}$ ^{}$ @\n'.format(freq, sl, tl))
+                    first = False
+                else:
+                    freq_lex_file.write('{} ^{}$ ^{}$\n'.format(freq, sl, tl))
 
-    # extract phrase alignments
+@stage
+def extract_candidates(pair_data, source, target, corpus_name, data_folder,
+                       giza_final, alignments_fname, yasmet_data, count=True, gdefbinfname=None,
+                       bt_fname=None, lines_fname=None, invert_alignments=False):
+    """
+    Read phrases, alignments and clean biltrans output together in one pass,
+    writing candidate sentences and collecting frequency lexicon counts and
+    maxent events on the way. Only candidates (with their tokens sidecar
+    and weights), lexicon, events and n-grams are written.
+    Without count, only the candidates are written, to be counted in shards.
+    For a corpus from dedup_corpus, the biltrans is read from bt_fname, and
+    every candidate is numbered after its first copy and weighted by its
+    number of copies, as listed in lines_fname.
+    With invert_alignments, the alignments are those of target-source.
+    """
     pair = '{}-{}'.format(source, target)
-    extract_pipe = pipes.Template()
-    extract_pipe.append('zcat $IN', 'f-')
-    extract_pipe.append(os.path.join(lextools, 'scripts', 'giza-to-moses.awk'), '--')
-
-    giza_final = 'giza.{}.A3.final.gz'.format(os.path.join(pair, pair))
-    phrases_fname = os.path.join(data_folder, 
-                                 '{}.phrases.{}'.format(corpus_name, pair))
-    phrasetable_fname = os.path.join(data_folder, 
-                                     '{}.phrasetable.{}'.format(corpus_name, pair))
-    
-    extract_pipe.copy(giza_final, phrases_fname)
-
-    cb_pipe = pipes.Template()
-    cb_pipe.append('{} {}.autobil.bin -b'.format(os.path.join(lextools, 'multitrans'),
-                                                 os.path.join(pair_data, pair)), '--')
-    cb_pipe.append('lrx-proc -m ' + os.path.join(data_folder, 'global-defaults.{}.bin'.format(pair)), '--')
-    clean_biltrans_fname = os.path.join(data_folder, '{}.clean-biltrans.{}'.format(corpus_name,  pair))
-
-    with open(phrases_fname, 'r', encoding='utf-8') as pfile,\
-         open(os.path.join('model', 'aligned.grow-diag-final-and'), 'r', encoding='utf-8') as agdfinal,\
-         open(phrasetable_fname, 'w', encoding='utf-8') as ptfile,\
-         cb_pipe.open(clean_biltrans_fname, 'w') as cb_pipefile:
-        for phrase_info, alignment in zip(pfile, agdfinal):
-            phrases = phrase_info.split('|||')
-            ptfile.write('|||'.join(phrases[0:2] + [alignment]))
-            cb_pipefile.write(phrases[1].replace('~', ' ') + '\n')
-
-    # extract candidate sentences
-    cand_fname = os.path.join(data_folder, '{}.candidates.{}'.format(corpus_name, pair))
+    gdefbinfname = gdefbinfname or os.path.join(data_folder, 'global-defaults.{}.bin'.format(pair))
+    extract_command = 'zcat "{}" | {}'.format(giza_final, os.path.join(lextools, 'scripts', 'giza-to-moses.awk'))
+    cb_command = clean_biltrans_command(pair_data, source, target, gdefbinfname)
+    cand_fname = compressed(os.path.join(data_folder, '{}.candidates.{}'.format(corpus_name, pair)))
+    freq_lex_fname = lex_fname(data_folder, corpus_name, source, target)
+
+    vocab = Vocab()
+    sl_tl, events, ngrams, numbering = count_tables(vocab, data_folder)
+    rows = deque()
     not_ambiguous = []
     lineno, total_valid, total_errors = 0, 0, 0
-    with open(phrasetable_fname, 'r', encoding='utf-8') as ptfile,\
-         open(clean_biltrans_fname, 'r', encoding='utf-8') as btfile,\
-         open(cand_fname, 'w', encoding='utf-8') as candfile:
-        for pt_line, bt_line in zip(ptfile, btfile):
+    tokensfile = TokensWriter(cand_fname)
+    extract = Popen(extract_command, shell=True, stdout=PIPE)
+    with io.TextIOWrapper(extract.stdout, encoding='utf-8') as pfile,\
+         open_file(alignments_fname, 'r') as agdfinal,\
+         open_file(cand_fname, 'w') as candfile,\
+         open_file(weights_fname(cand_fname), 'w') as weightsfile:
+        def sl_lines():
+            for phrase_info, alignment in zip(pfile, agdfinal):
+                if invert_alignments:
+                    alignment = invert_alignment(alignment)
+                row = phrase_info.split('|||')[0:2] + [alignment]
+                rows.append(row)
+                yield row[1].replace('~', ' ')
+
+        if bt_fname is None:
+            bt_lines = pool.map(cb_command, sl_lines())
+        else:
+            bt_file = open_file(bt_fname, 'r')
+            bt_lines = (bt_line for sl_line, bt_line in zip(sl_lines(), bt_file))
+        lines_file = lines_fname and open_file(lines_fname, 'r')
+
+        for bt_line in bt_lines:
+            row = rows.popleft()
             lineno += 1
+            first_lineno, weight = lineno, 1
+            if lines_file:
+                copies = lines_file.readline().split()
+                first_lineno, weight = copies[0], len(copies)
             try:
-                pt_line, bt_line = pt_line.strip(), bt_line.strip()
-
-                if pt_line == '' or bt_line == '':
+                bt_line = bt_line.strip()
+                if bt_line == '':
                     continue 
 
-                row = pt_line.split('|||')
-                bt = common.tokenise_biltrans_line(bt_line.strip())
-                sl = common.tokenise_tagger_line(row[1].strip())
-                tl = common.tokenise_tagger_line(row[0].strip())
+                bt = tokenise_biltrans_line(bt_line)
+                sl = tokenise_tagger_line(row[1].strip())
+                tl = tokenise_tagger_line(row[0].strip())
 
                 if not is_ambiguous(bt):
                     not_ambiguous.append(str(lineno))
@@ -276,72 +622,62 @@ def align_corpus(pair_data, source, target, pair_name, corpus_name, data_folder)
                 if len(sl) != len(bt):
                     print("len(sl) != len(bt)", file=sys.stderr)
 
-                candfile.write('{}\t{}\n'.format(lineno, row[1].strip()))
-                candfile.write('{}\t{}\n'.format(lineno, bt_line))
-                candfile.write('{}\t{}\n'.format(lineno, row[0].strip()))
-                candfile.write('{}\t{}\n'.format(lineno, row[2].strip()))
+                al_index = index_alignments(row[2].strip().split(' '))
+                sl_ids, tl_ids = vocab.intern_all(sl), vocab.intern_all(tl)
+                bt_ids = [(vocab.intern(token['sl']), vocab.intern_all(token['tls'])) for token in bt]
+                candfile.write('{}\t{}\n'.format(first_lineno, row[1].strip()))
+                candfile.write('{}\t{}\n'.format(first_lineno, bt_line))
+                candfile.write('{}\t{}\n'.format(first_lineno, row[0].strip()))
+                candfile.write('{}\t{}\n'.format(first_lineno, row[2].strip()))
                 candfile.write('-' * 80 + '\n')
+                weightsfile.write('{}\n'.format(weight))
+                tokensfile.write(sl_ids, bt_ids, tl_ids, al_index)
                 total_valid += 1
             except:
                 print("error in line", lineno, file=sys.stderr)
                 total_errors += 1
+                continue
+
+            if not count:
+                continue
+
+            # frequency lexicon counts and maxent events of the candidate
+            for i, sl_id, tl_id in aligned_words(sl_ids, bt, tl_ids, al_index):
+                sl_tl.add(sl_id, tl_id, weight)
+                events.append((sl_id, tl_id, get_features(sl_ids, i, ngrams), weight))
+        if bt_fname is not None:
+            bt_file.close()
+        if lines_file:
+            lines_file.close()
+    if extract.wait():
+        raise CalledProcessError(extract.returncode, extract_command)
+    tokensfile.close(vocab)
+    add_lines(lineno, total_valid)
     print('total:', lineno, file=sys.stderr)
     print('valid: {} ({:.1%})'.format(total_valid, total_valid/lineno), file=sys.stderr)
     print('errors: {} ({:.1%})'.format(total_errors, total_errors/lineno), file=sys.stderr)
 
-    # extract frequency lexicon
-    sl_tl, ngrams = {}, {}
-    with open(cand_fname, 'r', encoding='utf-8') as candfile:
-        while True:
-            try:
-                cur_sl_row = common.tokenise_tagger_line(candfile.readline().strip().split('\t')[1])
-                cur_bt_row = common.tokenise_biltrans_line(candfile.readline().strip().split('\t')[1])
-                cur_tl_row = common.tokenise_tagger_line(candfile.readline().strip().split('\t')[1])
-                cur_al_row = candfile.readline().strip().split('\t')[1].split(' ')
-                candfile.readline()
-            except IndexError:
-                print("Something's wrong with {} ".format(candfile))
-                break
-            except EOFError:
-                break
-
-            for i, (slword, btword) in enumerate(zip(cur_sl_row, cur_bt_row)):
-                if len(btword['tls']) > 1:
-                    for al in cur_al_row:
-                        al_sl = int(al.split('-')[1])
-                        al_tl = int(al.split('-')[0])
-                        if al_sl == i:
-                            tlword = cur_tl_row[al_tl]
-                            sl_tl.setdefault(slword, {})
-                            sl_tl[slword].setdefault(tlword, 0)
-                            sl_tl[slword][tlword] += 1
-
-    freq_lex_fname = os.path.join(data_folder, '{}.lex.{}'.format(corpus_name, pair))
-    with open(freq_lex_fname, 'w', encoding='utf-8') as freq_lex_file:
-        for sl, tl_freq_dict in sl_tl.items():
-            first_tag_sl = sl.split('<')[1].split('>')[0].strip()
-            tl_sorted = sorted(tl_freq_dict, key=tl_freq_dict.get, reverse=True)
-            first = True
-            for tl in tl_sorted:
-                if tl.startswith('*'):
-                    print('tl word "{}" is unknown'.format(tl),  file=sys.stderr)
-                    continue
-                first_tag_tl = tl.split('<')[1].split('>')[0].strip()
-                if first_tag_sl != first_tag_tl:
-                    print('{} != {}'.format(first_tag_sl, first_tag_tl), file=sys.stderr)
-                    continue
-                if first:
-                    freq_lex_file.write('{} ^{}$ ^{}$ @\n'.format(sl_tl[sl][tl], sl, tl))
-                    first = False
-                else:
-                    freq_lex_file.write('{} ^{}$ ^{}$\n'.format(sl_tl[sl][tl], sl, tl))
+    if not count:
+        return cand_fname, None, None, None
+    write_freq_lex_file(sl_tl, vocab, freq_lex_fname)
+    event_fname, ngram_fname = write_events(events, vocab, numbering, freq_lex_fname, yasmet_data)
+    return cand_fname, freq_lex_fname, event_fname, ngram_fname
 
-    return cand_fname, freq_lex_fname
+def lex_fname(data_folder, corpus_name, source, target):
+    """
+    The frequency lexicon file of a corpus.
+    """
+    return os.path.join(data_folder, '{}.lex.{}-{}'.format(corpus_name, source, target))
 
 def read_freq_lex_file(freq_lex_fname):
     """
-    Read and parse frequency lexicon.
+    Read and parse frequency lexicon, once for every version of the file.
+    The dictionaries returned are shared and must not be modified.
     """
+    return parse_freq_lex_file(freq_lex_fname, *file_stamp(freq_lex_fname))
+
+@lru_cache(maxsize=2)
+def parse_freq_lex_file(freq_lex_fname, size, mtime):
     sl_tl, sl_tl_defaults = {}, {}
     index, rindex = {}, {}
     trad_counter = {}
@@ -367,143 +703,279 @@ def read_freq_lex_file(freq_lex_fname):
 
     return sl_tl, sl_tl_defaults, index, rindex
 
-def ngram_count_patterns_maxent(cand_fname, freq_lex_fname, yasmet_data):
-    event_fname = os.path.join(yasmet_data, 'events')
-    ngram_fname = os.path.join(yasmet_data, 'ngrams')
-
-    sl_tl, sl_tl_defaults, index, rindex = read_freq_lex_file(freq_lex_fname)
-
-    ngrams = {}
-    event_counter = 0
-    features = {} # features[(slword, ['a', 'list'], tlword)] = 3
-    feature_counter = 0
+def weights_fname(cand_fname):
+    return llfile.compressed_fname(llfile.plain_fname(cand_fname) + '.weights', llfile.name_compression(cand_fname))
 
-    with open(cand_fname, 'r', encoding='utf-8') as candfile,\
-         open(event_fname, 'w', encoding='utf-8') as eventfile:
-        while True:
+def read_candidates(cand_fname, start=0, stop=None):
+    """
+    Yield tokenised (sl, bt, tl) rows of the candidates file with their alignment index
+    and weight, for candidates start to stop (all by default).
+    The tokens sidecar is read instead of the candidates when it is there.
+    """
+    weights = read_weights(cand_fname, start, stop)
+    words = read_tokens_words(cand_fname)
+    if words is not None:
+        for (sl_ids, bt_ids, tl_ids, al_index), weight in zip(read_tokens(cand_fname, start, stop), weights):
+            yield ([words[word_id] for word_id in sl_ids],
+                   [{'sl': words[sl_id], 'tls': [words[tl_id] for tl_id in tl_ids]} for sl_id, tl_ids in bt_ids],
+                   [words[word_id] for word_id in tl_ids], al_index, weight)
+        return
+
+    with open_file(cand_fname, 'r') as candfile:
+        for _ in range(start * 5):
+            candfile.readline()
+        while stop is None or start < stop:
             try:
-                cur_sl_row = common.tokenise_tagger_line(candfile.readline().strip().split('\t')[1])
-                cur_bt_row = common.tokenise_biltrans_line(candfile.readline().strip().split('\t')[1])
-                cur_tl_row = common.tokenise_tagger_line(candfile.readline().strip().split('\t')[1])
-                cur_al_row = candfile.readline().strip().split('\t')[1].split(' ')
+                cur_sl_row = tokenise_tagger_line(candfile.readline().strip().split('\t')[1])
+                cur_bt_row = tokenise_biltrans_line(candfile.readline().strip().split('\t')[1])
+                cur_tl_row = tokenise_tagger_line(candfile.readline().strip().split('\t')[1])
+                cur_al_index = index_alignments(candfile.readline().strip().split('\t')[1].split(' '))
                 candfile.readline()
             except IndexError:
                 break
             except EOFError:
                 break
+            yield cur_sl_row, cur_bt_row, cur_tl_row, cur_al_index, next(weights)
+            start += 1
+
+def read_weights(cand_fname, start=0, stop=None):
+    """
+    Yield the weights of candidates start to stop; 1 for every candidate
+    of a candidates file written without weights.
+    """
+    if not os.path.exists(weights_fname(cand_fname)):
+        yield from itertools.repeat(1)
+        return
+    with open_file(weights_fname(cand_fname), 'r') as weightsfile:
+        for line in itertools.islice(weightsfile, start, stop):
+            yield int(line)
+
+def count_candidates(cand_fname):
+    """
+    Number of candidates (5-line records) in a candidates file.
+    """
+    with open_file(cand_fname, 'rb') as candfile:
+        return sum(block.count(b'\n') for block in iter(lambda: candfile.read(1 << 20), b'')) // 5
 
-            for i, (slword, btword) in enumerate(zip(cur_sl_row, cur_bt_row)):
-                slword = '^{}$'.format(slword.lower())
-                if len(btword['tls']) > 1:
-                    for al in cur_al_row:
-                        al_sl = int(al.split('-')[1])
-                        al_tl = int(al.split('-')[0])
-                        if al_sl == i:
-
-                            tlword = '^{}$'.format(cur_tl_row[al_tl].lower())
-
-                            if tlword.startswith('^*') or slword.startswith('^*'):
-                                # unknown word
-                                continue
-
-                            if slword not in sl_tl_defaults:
-                                print('"{}" not in sl_tl_defaults, skipping'.format(slword), file=sys.stderr)
-                                continue
-
-                            if (slword, tlword) not in index:
-                                print('Pair ({}, {}) not in index'.format(slword, tlword), file=sys.stderr)
-                                continue
-
-                            ngrams = {}
-                            meevents = {} # events[slword][counter] = [feat, feat, feat];
-                            meoutcomes = {} # meoutcomes[slword][counter] = tlword;
-
-                            for j in range(1, max_ngrams):
-                                pregram = ' '.join(('^{}$'.format(gram) for gram in cur_sl_row[i-j:i+1]))
-                                postgram = ' '.join(('^{}$'.format(gram) for gram in cur_sl_row[i:i+j+1]))
-                                roundgram = ' '.join(('^{}$'.format(gram) for gram in cur_sl_row[i-j:i+j+1]))
-
-                                ngrams.setdefault(slword, {})
-                                ngrams[slword].setdefault(pregram, {})
-                                ngrams[slword].setdefault(postgram, {})
-                                ngrams[slword].setdefault(roundgram, {})
-                                ngrams[slword][pregram].setdefault(tlword, 0)
-                                ngrams[slword][pregram][tlword] += 1
-                                ngrams[slword][postgram].setdefault(tlword, 0)
-                                ngrams[slword][postgram][tlword] += 1
-                                ngrams[slword][roundgram].setdefault(tlword, 0)
-                                ngrams[slword][roundgram][tlword] += 1
-
-                            meevents.setdefault(slword, {})
-                            meoutcomes.setdefault(slword, {})
-                            meevents[slword].setdefault(event_counter, [])
-                            meoutcomes[slword].setdefault(event_counter, '')
-
-                            for ni in ngrams[slword]:
-                                if ni not in features:
-                                    feature_counter += 1
-                                    features[ni] = feature_counter
-                                meevents[slword][event_counter].append(features[ni])
-                                #meevents[slword][event_counter].append(feat)
-                                meoutcomes[slword][event_counter] = tlword
-                    
-                            if len(sl_tl[slword]) < 2:
-                                continue
-
-                            for event in meevents[slword]:
-                                outline = str(index[(slword, meoutcomes[slword][event])]) + ' # '
-                                for j in range(0,  len(sl_tl[slword])):
-                                    for feature in meevents[slword][event]:
-                                        outline = outline + str(feature) + ':' + str(j) + ' '
-                                    outline = outline + ' # '
-                                eventfile.write('{}\t{}\t{}\n'.format(slword, len(sl_tl[slword]), outline))
-            event_counter += 1
+def count_shard(cand_fname, shard_fname, start, stop):
+    """
+    Map step of sharded counting: count the frequency lexicon pairs and
+    maxent events of candidates start to stop into a count shard.
+    """
+    vocab = Vocab()
+    sl_tl, events = count_tables(vocab, os.path.dirname(os.path.abspath(shard_fname)))[:2]
+    for sl_row, bt_row, tl_row, al_index, weight in read_candidates(cand_fname, start, stop):
+        sl_ids, tl_ids = vocab.intern_all(sl_row), vocab.intern_all(tl_row)
+        for i, sl_id, tl_id in aligned_words(sl_ids, bt_row, tl_ids, al_index):
+            sl_tl.add(sl_id, tl_id, weight)
+            events.append((sl_id, tl_id, get_features(sl_ids, i, None), weight))
+    info = {'candidates': os.path.relpath(cand_fname, data_folder), 'start': start, 'stop': stop, 'max_ngrams': max_ngrams}
+    write_shard(shard_fname, info, vocab, sl_tl, events)
+    return shard_fname
+
+def merge_count_shards(shard_fnames, freq_lex_fname, yasmet_data):
+    """
+    Reduce step of sharded counting: merge count shards, in candidate order,
+    into the frequency lexicon and the events and n-grams files.
+    The result is the same as counting all candidates in one pass.
+    Shards of several candidates files are merged in the order the files are first given.
+    """
+    infos = [(read_shard_info(fname), fname) for fname in shard_fnames]
+    files = {}
+    for info, fname in infos:
+        files.setdefault(info['candidates'], len(files))
+    infos.sort(key=lambda x: (files[x[0]['candidates']], x[0]['start']))
+    check_shards([info for info, fname in infos])
+    shard_fnames = [fname for info, fname in infos]
+
+    vocab = Vocab()
+    sl_tl, events, ngrams, numbering = count_tables(vocab, yasmet_data)
+    word_ids = [] # word_ids[shard][shard word id] = word id
+    for shard_fname in shard_fnames:
+        info, words, pairs = read_shard_counts(shard_fname)
+        ids = vocab.intern_all(words)
+        word_ids.append(ids)
+        for k in range(0, len(pairs), 3):
+            sl_tl.add(ids[pairs[k]], ids[pairs[k + 1]], pairs[k + 2])
+    write_freq_lex_file(sl_tl, vocab, freq_lex_fname)
+
+    def merged_events():
+        for shard_fname, ids in zip(shard_fnames, word_ids):
+            for sl_id, tl_id, shard_ngrams, count in read_shard_events(shard_fname):
+                features = [tuple(ids[word_id] for word_id in ngram) for ngram in shard_ngrams]
+                yield ids[sl_id], ids[tl_id], features if ngrams is None else ngrams.intern_all(features), count
+    event_fname, ngram_fname = write_events(merged_events(), vocab, numbering, freq_lex_fname, yasmet_data)
+    return freq_lex_fname, event_fname, ngram_fname
+
+@stage
+def count_sharded(cand_fname, freq_lex_fname, yasmet_data, shards=count_shards, jobs=count_jobs):
+    """
+    Count the candidates file in shards on local worker processes, then merge them.
+    """
+    nrecords = count_candidates(cand_fname)
+    add_lines(nrecords)
+    bounds = [nrecords * k // shards for k in range(shards + 1)]
+    shard_fnames = ['{}.counts.{}'.format(cand_fname, k) for k in range(shards)]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(count_shard, [cand_fname] * shards, shard_fnames, bounds[:-1], bounds[1:]))
+    result = merge_count_shards(shard_fnames, freq_lex_fname, yasmet_data)
+    for shard_fname in shard_fnames:
+        os.remove(shard_fname)
+    return result
+
+def write_events(events, vocab, numbering, freq_lex_fname, yasmet_data):
+    """
+    Number the features of (slword id, tlword id, n-grams, count) events
+    and write them as compact event records, along with the numbered n-grams.
+    """
+    event_fname = os.path.join(yasmet_data, 'events')
+    ngram_fname = os.path.join(yasmet_data, 'ngrams')
+
+    sl_tl, sl_tl_defaults, index, rindex = read_freq_lex_file(freq_lex_fname)
+
+    words = {} # words[word id] = '^word<n><sg>$'
+
+    with EventWriter(event_fname, numbering.record_type) as eventfile:
+        for sl_id, tl_id, ngram_keys, count in events:
+            for word_id in (sl_id, tl_id):
+                if word_id not in words:
+                    words[word_id] = '^{}$'.format(vocab[word_id].lower())
+            slword, tlword = words[sl_id], words[tl_id]
+
+            if tlword.startswith('^*') or slword.startswith('^*'):
+                # unknown word
+                continue
+
+            if slword not in sl_tl_defaults:
+                print('"{}" not in sl_tl_defaults, skipping'.format(slword), file=sys.stderr)
+                continue
+
+            if (slword, tlword) not in index:
+                print('Pair ({}, {}) not in index'.format(slword, tlword), file=sys.stderr)
+                continue
+
+            meevent = [numbering.number(ni) for ni in ngram_keys]
+
+            if len(sl_tl[slword]) < 2:
+                continue
+
+            eventfile.write(slword, len(sl_tl[slword]), index[(slword, tlword)], count, meevent)
 
     with open(ngram_fname, 'w', encoding='utf-8') as ngramfile:
-        for feature, number in sorted(features.items(), key=lambda x: x[0]):
+        for feature, number in numbering.items():
             ngramfile.write('{}\t{}\n'.format(number, feature))
 
     return event_fname, ngram_fname
 
-def get_lambdas(yasmet_data, event_fname):
+@stage
+def ngram_count_patterns_maxent(cand_fname, freq_lex_fname, yasmet_data):
     """
-    Learn weights with yasmet.
+    Extract maxent events from an existing candidates file.
+    """
+    vocab = Vocab()
+    ngrams, numbering = count_tables(vocab, yasmet_data)[2:]
+    ncandidates = [0]
+    def events():
+        for cur_sl_row, cur_bt_row, cur_tl_row, cur_al_index, weight in read_candidates(cand_fname):
+            ncandidates[0] += 1
+            yield from sentence_events(vocab.intern_all(cur_sl_row), cur_bt_row,
+                                       vocab.intern_all(cur_tl_row), cur_al_index, ngrams, weight)
+
+    result = write_events(events(), vocab, numbering, freq_lex_fname, yasmet_data)
+    add_lines(ncandidates[0])
+    return result
+
+def train_word(yasmet_data, nclasses, event_fname, offsets, min_ngrams):
+    """
+    Learn weights for one word with yasmet, in a temporary folder of its own.
+    The word's events are read from their records and expanded to yasmet lines here,
+    each line repeated as many times as its event was seen.
+    Return the lines of lambdas.
     """
-    event_dict = {}
-    min_ngrams = max_ngrams * 2 - 1
-    with open(event_fname, 'r', encoding='utf-8') as eventfile:
-        for line in eventfile:
-            parts = line.strip().split('\t')
-            if len(parts) == 3:
-                word, count, event = parts
-                event_dict.setdefault(word, (count, []))
-                event_dict[word][1].append(event)
-
-    print(sorted(event_dict.keys()))
-
     yasmet = os.path.join(lextools, 'yasmet')
     yasmet_pipe = pipes.Template()
     yasmet_pipe.append('{} -red {}'.format(yasmet, min_ngrams), '--')
     yasmet_pipe.append(yasmet, '--')
-    all_lambdas_fname = os.path.join(yasmet_data, 'all-lambdas')
-    tmp_flist = []
 
+    tmp_dir = tempfile.mkdtemp(prefix='tmp.', dir=yasmet_data)
+    yasmet_tmp_fname = os.path.join(tmp_dir, 'yasmet')
+    lambdas_tmp_fname = os.path.join(tmp_dir, 'lambdas')
+    with open(yasmet_tmp_fname, 'w', encoding='utf-8') as tmp:
+        tmp.write('{}\n'.format(nclasses))
+        for outcome, count, features in read_events(event_fname, offsets):
+            tmp.write('{}\n'.format(yasmet_line(nclasses, outcome, features)) * count)
+    yasmet_pipe.copy(yasmet_tmp_fname, lambdas_tmp_fname)
+    with open(lambdas_tmp_fname, 'r', encoding='utf-8') as ltmp:
+        lambdas = ltmp.readlines()
+    shutil.rmtree(tmp_dir)
+    return lambdas
+
+def trainer_settings():
+    """
+    The training settings lambdas depend on: the yasmet binary.
+    """
+    yasmet = os.path.join(lextools, 'yasmet')
+    return [file_stamp(yasmet)]
+
+@stage
+def get_lambdas(yasmet_data, event_fname, jobs=yasmet_jobs):
+    """
+    Learn weights with yasmet, training up to jobs words at once.
+    Only record offsets are kept in memory; each job reads its own word's events.
+    The lambdas of every word are kept under a digest of its events and training
+    settings as soon as it is trained, so words whose events did not change
+    are not trained again, nor words trained before a run stopped, on resume.
+    """
+    min_ngrams = max_ngrams * 2 - 1
+    words = read_words(event_fname)
+    word_events = {} # word_events[word] = [classes, record offsets, size]
+    for offset, word_id, nclasses, outcome, count, nfeatures in scan_events(event_fname):
+        word_events.setdefault(words[word_id], [nclasses, array('Q'), 0])
+        word_events[words[word_id]][1].append(offset)
+        word_events[words[word_id]][2] += count * nclasses * nfeatures
+
+    print(sorted(word_events.keys()))
+
+    lambdas_folder = os.path.join(yasmet_data, 'lambdas')
+    if not os.path.exists(lambdas_folder):
+        os.mkdir(lambdas_folder)
+    # left behind by words being trained when a run stopped
+    for fname in os.listdir(yasmet_data):
+        if fname.startswith('tmp.'):
+            shutil.rmtree(os.path.join(yasmet_data, fname), ignore_errors=True)
+    settings = make_key(*trainer_settings(), min_ngrams)
+    digests = {word: hash_events(event_fname, offsets, hashlib.sha1('{} {}'.format(settings, nclasses).encode('utf-8'))).hexdigest()
+               for word, (nclasses, offsets, size) in word_events.items()}
+    retrain = [word for word in word_events
+               if not (use_stage_cache or resume) or not os.path.exists(os.path.join(lambdas_folder, digests[word]))]
+    print('Training {} of {} words'.format(len(retrain), len(word_events)))
+
+    # longest jobs first, so that no big word is left running alone at the end
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(train_word, yasmet_data, word_events[word][0], event_fname,
+                                   word_events[word][1], min_ngrams): word
+                   for word in sorted(retrain, key=lambda word: word_events[word][2], reverse=True)}
+        for future in as_completed(futures):
+            word = futures[future]
+            lambdas_fname = os.path.join(lambdas_folder, digests[word])
+            with open(lambdas_fname + '.tmp', 'w', encoding='utf-8') as lambdas_file:
+                lambdas_file.writelines(future.result())
+            os.replace(lambdas_fname + '.tmp', lambdas_fname)
+
+    all_lambdas_fname = os.path.join(yasmet_data, 'all-lambdas')
+    nlambdas = 0
     with open(all_lambdas_fname, 'w', encoding='utf-8') as all_lambdas_file:
-        for word, (count, events) in sorted(event_dict.items(), key=lambda x: x[0]):
-            word_safe = word.replace('^', '').replace('$', '').replace('*', '.').replace('#~', '_')
-            yasmet_tmp_fname = os.path.join(yasmet_data, 'tmp.yasmet.' + word_safe)
-            lambdas_tmp_fname = os.path.join(yasmet_data, 'tmp.lambdas.' + word_safe)
-            tmp_flist.extend([yasmet_tmp_fname, lambdas_tmp_fname])
-            with open(yasmet_tmp_fname, 'w', encoding='utf-8') as tmp:
-                tmp.write('{}\n'.format(count))
-                for event in events:
-                    tmp.write('{}\n'.format(event))
-            yasmet_pipe.copy(yasmet_tmp_fname, lambdas_tmp_fname)
-            with open(lambdas_tmp_fname, 'r', encoding='utf-8') as ltmp:
-                for line in ltmp:
+        for word in sorted(word_events):
+            with open(os.path.join(lambdas_folder, digests[word]), 'r', encoding='utf-8') as lambdas_file:
+                for line in lambdas_file:
                     all_lambdas_file.write(word + ' ' + line)
-    for fname in tmp_flist:
-        os.remove(fname)
+                    nlambdas += 1
+
+    add_lines(sum(len(offsets) for nclasses, offsets, size in word_events.values()), nlambdas)
+
+    # forget the lambdas of words whose events changed or went away
+    for fname in set(os.listdir(lambdas_folder)) - set(digests.values()):
+        os.remove(os.path.join(lambdas_folder, fname))
     return all_lambdas_fname, min_ngrams
 
 def get_lemma_and_tags(word):
@@ -557,6 +1029,7 @@ def make_xml_rule(weight, slword, ngram, tlword, lineno, ruleno):
     out += '  </rule>\n'
     return out, lineno + 1, ruleno + 1
 
+@stage
 def make_rules(pair_name, freq_lex_fname, yasmet_data, ngram_fname, all_lambdas_fname, min_ngrams):
     """
     Make files with weighted rules.
@@ -579,9 +1052,9 @@ def make_rules(pair_name, freq_lex_fname, yasmet_data, ngram_fname, all_lambdas_
          open(rules_all_fname, 'w', encoding='utf-8') as rule_file,\
          open(ngrams_all_fname, 'w', encoding='utf-8') as ngram_file,\
          open(final_rules_fname, 'w', encoding='utf-8') as final_file:
-        lineno, ruleno = 1, 1
+        lineno, ruleno, nlambdas = 1, 1, 0
         final_file.write('<rules>\n')
-        for line in lambda_file:
+        for nlambdas, line in enumerate(lambda_file, 1):
             if '@@@' not in line:
                 slword, ngid, trad, lbda = line.strip().replace(':', ' ').split(' ')
                 ngram = ngram_dict[int(ngid)]
@@ -604,57 +1077,326 @@ def make_rules(pair_name, freq_lex_fname, yasmet_data, ngram_fname, all_lambdas_
                     if xml_rule is not None:
                         final_file.write(xml_rule)
         final_file.write('</rules>')
+    add_lines(nlambdas, ruleno - 1)
+    return final_rules_fname
 
-def extract_maxent(pair_data, source, target, corpus_pair_name, corpus_name, data_folder, cand_fname, freq_lex_fname):
+def get_yasmet_data(source, target, folder=''):
     """
-    Run all stuff concerning maximum entropy learning.
+    Folder for maxent data and the final rules, in folder
+    (by default the working directory).
     """
-    pair = '{}-{}'.format(source, target)
-    yasmet_data = 'yasmet.' + pair
+    yasmet_data = os.path.join(folder, 'yasmet.{}-{}'.format(source, target))
     if not os.path.exists(yasmet_data):
-        os.mkdir(yasmet_data)
-    event_fname, ngram_fname = ngram_count_patterns_maxent(cand_fname, freq_lex_fname, yasmet_data)
-    all_lambdas_fname, min_ngrams = get_lambdas(yasmet_data, event_fname)
-    make_rules(corpus_pair_name, freq_lex_fname, yasmet_data, ngram_fname, all_lambdas_fname, min_ngrams)
-
-if __name__ == "__main__":
-    if not os.path.exists(data_folder):
-        os.makedirs(data_folder)
-
-    print('Preparing corpora')
-    btime = clock()
-
-    # tag corpora
-    slinecount, sfname = tag_corpus(pair_data, source, target, 
-                                    corpus_pair_name, corpus_folder,
-                                    corpus_name, data_folder)
-    tlinecount, tfname = tag_corpus(pair_data, target, source,
-                                    corpus_pair_name, corpus_folder,
-                                    corpus_name, data_folder)
+        os.makedirs(yasmet_data)
+    return yasmet_data
 
-    # clean tags (using moses script)
-    sfname, tfname = clean_tags(corpus_pair_name, sfname, tfname, source, target, corpus_name, data_folder)
-
-    # trim tags
+def extract_maxent(pair_data, source, target, corpus_pair_name, corpus_name, data_folder, cand_fname, freq_lex_fname,
+                   event_fname=None, ngram_fname=None, key='', suffix='', maxent_folder=''):
+    """
+    Run all stuff concerning maximum entropy learning.
+    Events are counted from the candidates file unless extract_candidates already did it.
+    Each step is skipped if its inputs did not change since the previous run;
+    suffix tells apart the steps of the directions of a batch run, and
+    maxent_folder is where their maxent data and rules go.
+    """
+    yasmet_data = get_yasmet_data(source, target, maxent_folder)
+    if event_fname is None:
+        key = make_key('ngram_count_patterns_maxent', key, max_ngrams)
+        event_fname, ngram_fname = cache.run('ngram_count_patterns_maxent' + suffix, key,
+                                             ngram_count_patterns_maxent, cand_fname, freq_lex_fname, yasmet_data)
+    lambdas_key = make_key('get_lambdas', key, *trainer_settings())
+    all_lambdas_fname, min_ngrams = cache.run('get_lambdas' + suffix, lambdas_key,
+                                              get_lambdas, yasmet_data, event_fname)
+    return cache.run('make_rules' + suffix, make_key('make_rules', lambdas_key),
+                     make_rules, corpus_pair_name, freq_lex_fname, yasmet_data, ngram_fname, all_lambdas_fname, min_ngrams)
+
+def read_batches(data_folder):
+    """
+    Corpus batches learnt by earlier incremental runs, with the key they were learnt under.
+    """
+    batches_fname = os.path.join(data_folder, 'batches.json')
+    if not os.path.exists(batches_fname):
+        return {'key': None, 'batches': []}
+    with open(batches_fname, 'r', encoding='utf-8') as batches_file:
+        return json.load(batches_file)
+
+def write_batches(data_folder, state):
+    batches_fname = os.path.join(data_folder, 'batches.json')
+    with open(batches_fname + '.tmp', 'w', encoding='utf-8') as batches_file:
+        json.dump(state, batches_file, indent=1)
+    os.replace(batches_fname + '.tmp', batches_fname)
+
+def learn_batch(pair_data, source, target, start, batch_folder, gdefbinfname):
+    """
+    Tag, clean, trim, deduplicate and align up to maxlines corpus lines from line start on
+    in a folder of their own, then extract their candidates and count them into a shard.
+    Return the number of corpus lines and the shard.
+    """
+    # left over from a run that stopped half way, unless it is resumed
+    if not resume:
+        shutil.rmtree(batch_folder, ignore_errors=True)
+    os.makedirs(batch_folder, exist_ok=True)
+    (linecount, sfname), (tlinecount, tfname) = tag_corpora(pair_data, source, target,
+                                                            corpus_pair_name, corpus_folder,
+                                                            corpus_name, batch_folder, start=start)
+    sfname, tfname = clean_tags(corpus_pair_name, sfname, tfname, source, target, corpus_name, batch_folder)
     sfname = trim_tags(pair_data, source, target, lextools, sfname)
     tfname = trim_tags(pair_data, target, source, lextools, tfname)
-
-    print('The corpora were prepared successfully in {:f}'.format(clock() - btime))
+    bt_fname = lines_fname = None
+    if dedup_pairs:
+        sfname, tfname, bt_fname, lines_fname, _ = dedup_corpus(pair_data, source, target, corpus_pair_name,
+                                                                sfname, tfname, corpus_name, batch_folder, gdefbinfname)
+    giza_final, alignments_fname = align_corpus(pair_data, source, target, corpus_pair_name, corpus_name, batch_folder,
+                                                'unique' if dedup_pairs else 'trimmed')
+    cand_fname = extract_candidates(pair_data, source, target, corpus_name, batch_folder,
+                                    giza_final, alignments_fname, None, count=False, gdefbinfname=gdefbinfname,
+                                    bt_fname=bt_fname, lines_fname=lines_fname)[0]
+    shard_fname = count_shard(cand_fname, os.path.join(batch_folder, 'counts'), 0, count_candidates(cand_fname))
+    return linecount, shard_fname
+
+def learn_incremental(pair_data, source, target, pair_key, prepare_key):
+    """
+    Learn rules from the corpus lines added since the previous incremental run:
+    only the new lines are tagged, aligned and counted, as a new batch; the count
+    shards of all batches are then merged, and only words whose events changed are retrained.
+    The first batch starts at line corpus_start.
+    """
+    state = read_batches(data_folder)
+    key = make_key('incremental', pair_key, source, target, opencats, max_ngrams, corpus_start,
+                   clean_min_words, clean_max_words, clean_max_ratio, dedup_pairs)
+    if state['key'] != key:
+        if state['batches']:
+            print('Dictionaries or config changed since the previous run, learning from line {} again'.format(corpus_start + 1))
+            for batch in state['batches']:
+                shutil.rmtree(os.path.join(data_folder, batch['folder']), ignore_errors=True)
+        state = {'key': key, 'batches': []}
+    start = state['batches'][-1]['stop'] if state['batches'] else corpus_start
 
     print('Preparing data')
-    btime = clock()
-    prepare_data(pair_data, source, target, apertium_pair_name, data_folder)
-    print('The data was prepared successfully in {:f}'.format(clock() - btime))
-
-    print('Aligning corpus')
-    btime = clock()
-    cand_fname, freq_lex_fname = align_corpus(pair_data, source, target,
-                                              corpus_pair_name, 
-                                              corpus_name, data_folder)
-    print('Corpus was aligned successfully in {:f}'.format(clock() - btime))
+    make_autobil(pair_data, source, target)
+    gdefbinfname = cache.run('prepare_data', prepare_key, prepare_data,
+                             pair_data, source, target, apertium_pair_name, data_folder)
+
+    total = len(open_corpus(corpus_fnames(source, corpus_pair_name, corpus_folder, corpus_name, data_folder)[0]))
+    if total > start:
+        print('Learning corpus lines {} to {}'.format(start + 1, min(total, start + maxlines)))
+        btime = perf_counter()
+        folder = 'batch.{:03d}'.format(len(state['batches']))
+        linecount, shard_fname = learn_batch(pair_data, source, target, start,
+                                             os.path.join(data_folder, folder), gdefbinfname)
+        state['batches'].append({'folder': folder, 'start': start, 'stop': start + linecount, 'shard': shard_fname})
+        write_batches(data_folder, state)
+        print('The batch was learnt successfully in {:f}'.format(perf_counter() - btime))
+    else:
+        print('No corpus lines were added since line {}'.format(start))
 
     print('Extracting rules')
-    btime = clock()
-    extract_maxent(pair_data, source, target, corpus_pair_name, corpus_name,
-                   data_folder, cand_fname, freq_lex_fname)
-    print('Rules were extracted successfully in {:f}'.format(clock() - btime))
+    btime = perf_counter()
+    freq_lex_fname, event_fname, ngram_fname = merge_count_shards([batch['shard'] for batch in state['batches']],
+                                                                  lex_fname(data_folder, corpus_name, source, target),
+                                                                  get_yasmet_data(source, target))
+    extract_maxent(pair_data, source, target, corpus_pair_name, corpus_name, data_folder, None, freq_lex_fname,
+                   event_fname, ngram_fname, key=make_key(key, state['batches']))
+    print('Rules were extracted successfully in {:f}'.format(perf_counter() - btime))
+
+def batch_groups(directions):
+    """
+    The directions to learn, grouped by the language pair and corpus they share:
+    [(pair_data, apertium_pair_name, corpus_pair_name, [(source, target), ...])].
+    A direction is (source, target) of the configured pair and corpus, or
+    (source, target, pair_data, apertium_pair_name, corpus_pair_name);
+    with none, source-target is learnt.
+    """
+    groups = OrderedDict()
+    for direction in directions or [(source, target)]:
+        pair = tuple(direction[2:]) or (pair_data, apertium_pair_name, corpus_pair_name)
+        languages = groups.setdefault(pair, [])
+        if tuple(direction[:2]) not in languages:
+            languages.append(tuple(direction[:2]))
+    # the configured direction first, so that its stages keep their names
+    if (source, target) in groups.get((pair_data, apertium_pair_name, corpus_pair_name), ()):
+        groups[pair_data, apertium_pair_name, corpus_pair_name].sort(key=lambda direction: direction != (source, target))
+    return [pair + (languages,) for pair, languages in groups.items()]
+
+def add_pair_stages(graph, pair_data, apertium_pair_name, corpus_pair_name, directions, folder, suffix=''):
+    """
+    Add to graph the stages learning rules for directions between the languages
+    of one corpus with one language pair, in folder. The corpus is tagged,
+    cleaned, trimmed, deduplicated and aligned once for all of them, in the
+    first direction: MGIZA aligns both ways. Only the global defaults,
+    candidates and maxent rules are learnt for every direction.
+    Stage names end with suffix, and with the languages of every direction but the first.
+    Maxent data and rules go to the working directory for the configured pair
+    and corpus (no suffix), and to folder for any other, so that directions
+    learnt from several pairs do not share them.
+    """
+    source, target = directions[0]
+    if any(set(direction) != {source, target} for direction in directions):
+        raise ValueError('directions of {} must be between two languages: {}'.format(corpus_pair_name, directions))
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    def named(stage, direction=directions[0]):
+        return stage + suffix + ('' if direction == directions[0] else '.{}-{}'.format(*direction))
+
+    # stage cache keys
+    corpora = [open_corpus(corpus_fnames(lang, corpus_pair_name, corpus_folder, corpus_name, folder)[0])
+               for lang in (source, target)]
+    corpus_key = make_key('corpus', maxlines, corpus_start, corpus_sample_seed, source, target,
+                          *(hash_selection(corpus, corpus_lines(corpus)) for corpus in corpora))
+    pair_key = make_key('pair', hash_pair_data(pair_data))
+    tag_key = make_key('tag_corpora', corpus_key, pair_key)
+    clean_key = make_key('clean_tags', tag_key, clean_min_words, clean_max_words, clean_max_ratio)
+    trim_key = make_key('trim_tags', clean_key, pair_key)
+    prepare_keys = [make_key('prepare_data', pair_key, sl, tl, opencats) for sl, tl in directions]
+    dedup_key = make_key('dedup_corpus', trim_key, *prepare_keys)
+    align_key = make_key('align_corpus', dedup_key if dedup_pairs else trim_key)
+
+    graph.add(named('tag_corpora'),
+              lambda: cache.run(named('tag_corpora'), tag_key, tag_corpora,
+                                pair_data, source, target, corpus_pair_name, corpus_folder, corpus_name, folder))
+    graph.add(named('clean_tags'),
+              lambda tagged: cache.run(named('clean_tags'), clean_key, clean_tags,
+                                       corpus_pair_name, tagged[0][1], tagged[1][1],
+                                       source, target, corpus_name, folder),
+              named('tag_corpora'))
+    # the autobil.bin of a direction is rebuilt before anything reads it:
+    # trim_tags reads that of its side, whose direction may be learnt too
+    for sl, tl in directions:
+        graph.add(named('make_autobil', (sl, tl)), lambda sl=sl, tl=tl: make_autobil(pair_data, sl, tl))
+    def autobil_stages(direction):
+        return [named('make_autobil', direction)] if direction in directions else []
+    graph.add(named('trim_tags.' + source),
+              lambda cleaned, *autobil: cache.run(named('trim_tags.' + source), trim_key, trim_tags,
+                                                  pair_data, source, target, lextools, cleaned[0]),
+              named('clean_tags'), *autobil_stages((source, target)))
+    graph.add(named('trim_tags.' + target),
+              lambda cleaned, *autobil: cache.run(named('trim_tags.' + target), trim_key, trim_tags,
+                                                  pair_data, target, source, lextools, cleaned[1]),
+              named('clean_tags'), *autobil_stages((target, source)))
+    for (sl, tl), prepare_key in zip(directions, prepare_keys):
+        graph.add(named('prepare_data', (sl, tl)),
+                  lambda autobil, sl=sl, tl=tl, prepare_key=prepare_key:
+                      cache.run(named('prepare_data', (sl, tl)), prepare_key, prepare_data,
+                                pair_data, sl, tl, apertium_pair_name, folder),
+                  named('make_autobil', (sl, tl)))
+    if dedup_pairs:
+        graph.add(named('dedup_corpus'),
+                  lambda sfname, tfname, *gdefbinfnames: cache.run(named('dedup_corpus'), dedup_key, dedup_corpus,
+                                                                   pair_data, source, target, corpus_pair_name,
+                                                                   sfname, tfname, corpus_name, folder, *gdefbinfnames),
+                  named('trim_tags.' + source), named('trim_tags.' + target),
+                  *(named('prepare_data', direction) for direction in directions))
+        corpus_stages = [named('dedup_corpus')]
+    else:
+        corpus_stages = [named('trim_tags.' + source), named('trim_tags.' + target)]
+    graph.add(named('align_corpus'),
+              lambda *corpus: cache.run(named('align_corpus'), align_key, align_corpus,
+                                        pair_data, source, target, corpus_pair_name, corpus_name, folder,
+                                        'unique' if dedup_pairs else 'trimmed'),
+              *corpus_stages)
+
+    for (sl, tl), prepare_key in zip(directions, prepare_keys):
+        add_direction_stages(graph, named, pair_data, sl, tl, corpus_pair_name, folder, folder if suffix else '',
+                             (sl, tl) != (source, target),
+                             make_key('extract_candidates', align_key, prepare_key, max_ngrams, bool(count_shards)),
+                             corpus_stages)
+
+def add_direction_stages(graph, named, pair_data, source, target, corpus_pair_name, folder, maxent_folder, reverse,
+                         extract_key, corpus_stages):
+    """
+    Add to graph the stages learning rules for source-target from an alignment
+    made in the other direction if reverse, with maxent data in maxent_folder.
+    named names its stages.
+    """
+    direction = (source, target)
+    yasmet_data = get_yasmet_data(source, target, maxent_folder)
+    def dedup_files(deduped):
+        # biltrans and line numbers from dedup_corpus
+        return (deduped[4] if reverse else deduped[2]), deduped[3]
+    graph.add(named('extract_candidates', direction),
+              lambda aligned, gdefbinfname, *corpus: cache.run(named('extract_candidates', direction), extract_key,
+                                                              extract_candidates,
+                                                              pair_data, source, target, corpus_name, folder,
+                                                              giza_final_fname(folder, source, target), aligned[1],
+                                                              yasmet_data, not count_shards, None,
+                                                              *(dedup_files(corpus[0]) if dedup_pairs else (None, None)),
+                                                              invert_alignments=reverse),
+              named('align_corpus'), named('prepare_data', direction), *corpus_stages)
+    counted_stage = named('extract_candidates', direction)
+    if count_shards:
+        graph.add(named('count_sharded', direction),
+                  lambda extracted: (extracted[0],) + cache.run(named('count_sharded', direction),
+                                                                make_key('count_sharded', extract_key),
+                                                                count_sharded, extracted[0],
+                                                                lex_fname(folder, corpus_name, source, target),
+                                                                yasmet_data),
+                  named('extract_candidates', direction))
+        counted_stage = named('count_sharded', direction)
+    graph.add(named('extract_maxent', direction),
+              lambda counted: extract_maxent(pair_data, source, target, corpus_pair_name, corpus_name,
+                                             folder, *counted, key=extract_key,
+                                             suffix=named('', direction), maxent_folder=maxent_folder),
+              counted_stage)
+
+if __name__ == "__main__":
+    # go on with a run that stopped:
+    #   lexlearner.py --resume
+    if '--resume' in sys.argv[1:]:
+        sys.argv.remove('--resume')
+        resume = cache.enabled = True
+
+    # count one slice of candidates on this machine, or merge count shards made anywhere:
+    #   lexlearner.py count-shard CANDIDATES START STOP SHARD
+    #   lexlearner.py merge-shards LEX SHARD...
+    if sys.argv[1:2] == ['count-shard']:
+        count_shard(sys.argv[2], sys.argv[5], int(sys.argv[3]), int(sys.argv[4]))
+        sys.exit()
+    if sys.argv[1:2] == ['merge-shards']:
+        merge_count_shards(sys.argv[3:], sys.argv[2], get_yasmet_data(source, target))
+        sys.exit()
+
+    if not os.path.exists(data_folder):
+        os.makedirs(data_folder)
+    if run_report:
+        report.fname = os.path.join(data_folder, run_report)
+        report.concurrent = stage_jobs > 1 and not incremental
+        report.config = {'source': source, 'target': target, 'corpus': corpus_name, 'maxlines': maxlines,
+                         'corpus_start': corpus_start, 'corpus_sample_seed': corpus_sample_seed,
+                         'max_ngrams': max_ngrams, 'pool_workers': pool_workers, 'tagger_jobs': tagger_jobs,
+                         'mgiza_cpus': mgiza_cpus, 'yasmet_jobs': yasmet_jobs, 'count_shards': count_shards,
+                         'count_memory_mb': count_memory_mb, 'dedup_pairs': dedup_pairs,
+                         'incremental': incremental, 'use_stage_cache': use_stage_cache,
+                         'batch_directions': batch_directions}
+
+    groups = batch_groups(batch_directions)
+    if incremental:
+        if groups != [(pair_data, apertium_pair_name, corpus_pair_name, [(source, target)])]:
+            sys.exit('Incremental runs learn {}-{} only, batch_directions must be empty'.format(source, target))
+        if corpus_sample_seed is not None:
+            sys.exit('Incremental runs learn consecutive corpus lines, corpus_sample_seed must be None')
+        pair_key = make_key('pair', hash_pair_data(pair_data))
+        prepare_key = make_key('prepare_data', pair_key, source, target, opencats)
+        learn_incremental(pair_data, source, target, pair_key, prepare_key)
+        report.save()
+        sys.exit()
+
+    # stages run as soon as the stages they need are done, up to stage_jobs at once;
+    # the configured pair and corpus are learnt from in data_folder, any other in a folder of its own
+    graph = StageGraph()
+    names = set()
+    for group_pair_data, group_apertium_pair_name, group_corpus_pair_name, directions in groups:
+        folder, suffix = data_folder, ''
+        if (group_pair_data, group_apertium_pair_name, group_corpus_pair_name) != (pair_data, apertium_pair_name, corpus_pair_name):
+            # numbered when the same pair is learnt from several pair_data
+            name = base_name = '{}.{}'.format(group_apertium_pair_name, group_corpus_pair_name)
+            while name in names:
+                name = '{}.{}'.format(base_name, len(names) + 1)
+            names.add(name)
+            folder, suffix = os.path.join(data_folder, name), '.' + name
+        add_pair_stages(graph, group_pair_data, group_apertium_pair_name, group_corpus_pair_name,
+                        directions, folder, suffix)
+
+    btime = perf_counter()
+    graph.run(stage_jobs)
+    print('Rules were extracted successfully in {:f}'.format(perf_counter() - btime))
+    report.save()
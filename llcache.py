@@ -0,0 +1,151 @@
+"""
+Content-addressed cache of pipeline stage results.
+
+Every stage is run under a key made of hashes of its inputs (corpus
+slice, dictionaries, config values and the keys of the stages it
+depends on). If the key and the output files recorded for it are
+unchanged, the stage is skipped and its previous result is reused.
+
+Every stage that finishes is recorded at once, atomically, so the
+manifest also marks the stages a stopped run completed. Long stages
+keep finer-grained progress in '.progress' files next to their outputs.
+"""
+
+import os, json, hashlib, threading
+
+manifest_name = 'stage-cache.json'
+
+def hash_file(fname, hasher=None):
+    """
+    sha1 of a file's contents.
+    """
+    hasher = hasher or hashlib.sha1()
+    with open(fname, 'rb') as ifile:
+        for block in iter(lambda: ifile.read(1 << 20), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def hash_pair_data(pair_data):
+    """
+    sha1 of the .dix, .bin and .prob files of a language pair.
+    Bilingual transducers built by prepare_data are left out:
+    they are compiled from the bilingual .dix, which is hashed.
+    """
+    hasher = hashlib.sha1()
+    for folder in (pair_data, os.path.join(pair_data, '.deps')):
+        if not os.path.isdir(folder):
+            continue
+        for fname in sorted(os.listdir(folder)):
+            if fname.endswith(('.dix', '.bin', '.prob')) and '.autobil.' not in fname:
+                hasher.update(fname.encode('utf-8'))
+                hash_file(os.path.join(folder, fname), hasher)
+    return hasher.hexdigest()
+
+def make_key(*parts):
+    """
+    Combine strings and config values into a stage key.
+    """
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=repr).encode('utf-8')).hexdigest()
+
+def result_files(result):
+    """
+    File names mentioned in a stage result; every string in one is a file name.
+    """
+    if isinstance(result, str):
+        return [result]
+    if isinstance(result, (list, tuple)):
+        return [fname for item in result for fname in result_files(item)]
+    return []
+
+def file_stamp(fname):
+    """
+    Size and modification time of a file, None if it is missing.
+    """
+    if not os.path.isfile(fname):
+        return None
+    stat = os.stat(fname)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def as_tuples(result):
+    """
+    Turn lists read back from json into the tuples stages return.
+    """
+    if isinstance(result, list):
+        return tuple(as_tuples(item) for item in result)
+    return result
+
+def progress_fname(fname):
+    return fname + '.progress'
+
+def read_progress(fname, key):
+    """
+    The progress recorded for fname under key, None if none was or it was under another key.
+    """
+    if not os.path.exists(progress_fname(fname)):
+        return None
+    with open(progress_fname(fname), 'r', encoding='utf-8') as ifile:
+        progress = json.load(ifile)
+    return progress['state'] if progress['key'] == key else None
+
+def write_progress(fname, key, state):
+    """
+    Atomically record the progress made on fname under key.
+    """
+    with open(progress_fname(fname) + '.tmp', 'w', encoding='utf-8') as ofile:
+        json.dump({'key': key, 'state': state}, ofile)
+    os.replace(progress_fname(fname) + '.tmp', progress_fname(fname))
+
+def clear_progress(fname):
+    if os.path.exists(progress_fname(fname)):
+        os.remove(progress_fname(fname))
+
+class StageCache:
+    """
+    Stage keys, results and output file stamps, kept in data_folder.
+    Finished stages are always recorded; they are only reused if enabled.
+    """
+    def __init__(self, data_folder, enabled=True):
+        self.enabled = enabled
+        self.fname = os.path.join(data_folder, manifest_name)
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.exists(self.fname):
+            with open(self.fname, 'r', encoding='utf-8') as ifile:
+                self.entries = json.load(ifile)
+
+    def get(self, stage, key):
+        """
+        Return (True, result) if stage was run with key and all its outputs are intact.
+        """
+        entry = self.entries.get(stage)
+        if not self.enabled or entry is None or entry['key'] != key:
+            return False, None
+        for fname, stamp in entry['outputs'].items():
+            if stamp is None or file_stamp(fname) != stamp:
+                return False, None
+        return True, as_tuples(entry['result'])
+
+    def put(self, stage, key, result):
+        """
+        Record the result of a stage run with key.
+        """
+        entry = {'key': key, 'result': result,
+                 'outputs': {fname: file_stamp(fname) for fname in result_files(result)}}
+        # stages may finish at the same time
+        with self.lock:
+            self.entries[stage] = entry
+            with open(self.fname + '.tmp', 'w', encoding='utf-8') as ofile:
+                json.dump(self.entries, ofile, indent=1, sort_keys=True)
+            os.replace(self.fname + '.tmp', self.fname)
+
+    def run(self, stage, key, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) unless its result for key is cached.
+        """
+        hit, result = self.get(stage, key)
+        if hit:
+            print('Reusing {} from a previous run'.format(stage))
+            return result
+        result = func(*args, **kwargs)
+        self.put(stage, key, result)
+        return result
@@ -15,3 +15,77 @@ data_folder = '/home/nm/source/apertium/friendly-lexical-selection-training/frie
 opencats=('n', 'vblex', 'adj')
 maxlines = 10000
 max_ngrams = 3
+
+# number of tagger pipelines to run at once on corpus shards
+tagger_jobs = 4
+
+# warm null-flush processes per command and lines sent to them at once
+pool_workers = 4
+pool_batch_lines = 1000
+
+# skip stages whose inputs did not change since the previous run
+use_stage_cache = True
+
+# run moses only up to symmetrized alignments, with this many mgiza threads
+alignment_only = True
+mgiza_cpus = 4
+
+# number of words trained with yasmet at once
+yasmet_jobs = 4
+
+# memory for counting tables in MB before they spill to disk, None for no limit
+count_memory_mb = None
+
+# count candidates in this many slices on count_jobs processes, 0 to count while extracting them
+count_shards = 0
+count_jobs = 4
+
+# keep the counts of earlier runs and only learn the corpus lines added since, maxlines at a time,
+# the first batch from line corpus_start on (corpus_sample_seed must be None)
+incremental = False
+
+# dictionary analyses remembered by prepare_data to skip translating repeats
+expand_window = 100000
+
+# memory for sorting the global-defaults rules of prepare_data, past which they are sorted on disk
+# (None for no limit)
+defaults_sort_memory_mb = 256
+
+# tokenised lines kept for reuse by each tokeniser; a 25-word biltrans line takes about 12 kB
+tokenise_cache_size = 4000
+
+# align one weighted copy of every sentence pair, and only pairs with ambiguous source words
+dedup_pairs = True
+
+# per-stage times, memory and throughput, written to this file in data_folder (None for no report)
+run_report = 'run-report.json'
+
+# compress intermediate files only read by lexlearner: None, 'gzip' or 'zstd';
+# intermediate files are read and written through buffers of io_buffer_size bytes
+compression = None
+compression_level = 3
+io_buffer_size = 1 << 20
+
+# pipeline stages run at once when they do not depend on each other
+stage_jobs = 4
+
+# tagged and trimmed lines written between progress checkpoints, which lexlearner.py --resume goes on from
+checkpoint_lines = 100000
+
+# learn from maxlines corpus lines from line corpus_start on (counted from 0),
+# or from a random sample of maxlines of those lines, drawn with corpus_sample_seed if it is not None
+corpus_start = 0
+corpus_sample_seed = None
+
+# tagged corpora are cleaned in chunks of clean_chunk_lines pairs on up to clean_jobs processes,
+# keeping pairs of clean_min_words to clean_max_words words a side, at most clean_max_ratio times as long as each other
+clean_jobs = 4
+clean_chunk_lines = 10000
+clean_min_words = 1
+clean_max_words = 40
+clean_max_ratio = 9
+
+# learn several directions in one run: (source, target) of the pair and corpus above, or
+# (source, target, pair_data, apertium_pair_name, corpus_pair_name); directions of the same pair and corpus
+# share their tagged corpora and one alignment. Empty to learn source-target only
+batch_directions = []
@@ -0,0 +1,121 @@
+"""
+Random access to the lines of a corpus file.
+
+A byte-offset index of the line starts of a corpus file is built once,
+kept in a file of its own, and rebuilt when the corpus changes; the
+corpus is then memory-mapped, so any range or sample of its lines is
+read without scanning from the start. Parallel files have the same line
+numbers, so reading the same selection from each side gives parallel
+lines, and workers can split a corpus by line numbers alone.
+Corpus files must be uncompressed.
+"""
+
+import os, sys, json, mmap, random, hashlib
+from array import array
+
+index_format = 'lexlearner-line-index'
+index_version = 1
+
+def build_index(fname):
+    """
+    Byte offsets of the starts of the lines of fname, followed by its size.
+    """
+    offsets = array('Q', [0])
+    pos = 0
+    with open(fname, 'rb') as ifile:
+        for block in iter(lambda: ifile.read(1 << 20), b''):
+            end = block.find(b'\n')
+            while end >= 0:
+                offsets.append(pos + end + 1)
+                end = block.find(b'\n', end + 1)
+            pos += len(block)
+    if offsets[-1] != pos:
+        # last line without a newline
+        offsets.append(pos)
+    return offsets
+
+def corpus_stamp(fname):
+    stat = os.stat(fname)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def write_index(index_fname, fname, offsets):
+    header = dict(corpus_stamp(fname), format=index_format, version=index_version,
+                  byteorder=sys.byteorder, lines=len(offsets) - 1)
+    with open(index_fname + '.tmp', 'wb') as index_file:
+        index_file.write((json.dumps(header, sort_keys=True) + '\n').encode('utf-8'))
+        offsets.tofile(index_file)
+    os.replace(index_fname + '.tmp', index_fname)
+
+def read_index(index_fname, fname):
+    """
+    The offsets kept in index_fname, None if there are none for fname as it is now.
+    """
+    if not os.path.exists(index_fname):
+        return None
+    with open(index_fname, 'rb') as index_file:
+        header = json.loads(index_file.readline().decode('utf-8'))
+        if header.get('format') != index_format or header.get('version') != index_version:
+            return None
+        if {key: header[key] for key in ('size', 'mtime_ns')} != corpus_stamp(fname):
+            return None
+        offsets = array('Q')
+        offsets.fromfile(index_file, header['lines'] + 1)
+    if header['byteorder'] != sys.byteorder:
+        offsets.byteswap()
+    return offsets
+
+class CorpusFile:
+    """
+    A memory-mapped corpus file and the index of its lines.
+    """
+    def __init__(self, fname, index_fname):
+        self.fname = fname
+        self.offsets = read_index(index_fname, fname)
+        if self.offsets is None:
+            self.offsets = build_index(fname)
+            write_index(index_fname, fname, self.offsets)
+        self.file = open(fname, 'rb')
+        if self.offsets[-1]:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = b''
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def line(self, number):
+        return self.map[self.offsets[number]:self.offsets[number + 1]].decode('utf-8')
+
+    def lines(self, numbers):
+        """
+        Yield the lines with the given numbers (counted from 0), newlines included.
+        """
+        for number in numbers:
+            yield self.line(number)
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+def select_lines(total, start, count=None, seed=None):
+    """
+    Numbers of count lines (all if None) of a corpus of total lines, from line start on:
+    the next count lines, or with seed, a sample of them drawn at random
+    with that seed, in corpus order.
+    """
+    population = range(min(start, total), total)
+    if count is None or count >= len(population):
+        return population
+    if seed is None:
+        return population[:count]
+    return array('q', sorted(random.Random(seed).sample(population, count)))
+
+def hash_selection(corpus, numbers):
+    """
+    sha1 of the selected lines of a corpus.
+    """
+    hasher = hashlib.sha1()
+    for number in numbers:
+        hasher.update(corpus.map[corpus.offsets[number]:corpus.offsets[number + 1]])
+    return hasher.hexdigest()
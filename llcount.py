@@ -0,0 +1,288 @@
+"""
+Integer-interned vocabularies and array-backed count tables
+for the frequency lexicon and n-gram counting.
+
+Given a budget of entries, tables spill sorted runs to temporary files
+and merge them at the end, so counting a large corpus needs bounded memory.
+"""
+
+import heapq, pickle, tempfile, hashlib
+from array import array
+from itertools import groupby
+from operator import itemgetter
+
+# items pickled at once in a run file
+run_chunk = 1000
+
+class Vocab:
+    """
+    Map hashable items (lexical units, n-gram id tuples) to consecutive ids and back.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.items = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, item_id):
+        return self.items[item_id]
+
+    def intern(self, item):
+        item_id = self.ids.get(item)
+        if item_id is None:
+            item_id = self.ids[item] = len(self.items)
+            self.items.append(item)
+        return item_id
+
+    def intern_all(self, items):
+        return array('q', map(self.intern, items))
+
+class PairCounts:
+    """
+    Counts of (first, second) id pairs.
+    Pairs are numbered in order of first appearance; the pair members
+    and counts live in parallel arrays indexed by that number.
+    With a budget, at most that many pairs are counted in memory: the
+    table is then spilled as a sorted run and counting starts afresh.
+    Pairs remember the number of the add() that first saw them, so merged
+    runs come out in the same order as an unbounded table.
+    """
+    def __init__(self, budget=None, tmp_dir=None):
+        self.budget = budget
+        self.tmp_dir = tmp_dir
+        self.runs = None
+        self.added = 0
+        self.slots = {} # slots[first << 32 | second] = slot
+        self.firsts = array('l')
+        self.seconds = array('l')
+        self.counts = array('q')
+        self.seqs = array('q')
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, first, second, count=1):
+        key = first << 32 | second
+        slot = self.slots.get(key)
+        if slot is None:
+            if self.budget is not None and len(self.counts) >= self.budget:
+                self.spill()
+            self.slots[key] = len(self.counts)
+            self.firsts.append(first)
+            self.seconds.append(second)
+            self.counts.append(count)
+            self.seqs.append(self.added)
+        else:
+            self.counts[slot] += count
+        self.added += 1
+
+    def spill(self):
+        """
+        Write the pairs counted so far as a sorted run and empty the table.
+        """
+        if self.runs is None:
+            self.runs = ExternalSorter(self.budget, tmp_dir=self.tmp_dir)
+        self.runs.write_run(zip(self.firsts, self.seconds, self.counts, self.seqs))
+        self.slots = {}
+        self.firsts, self.seconds = array('l'), array('l')
+        self.counts, self.seqs = array('q'), array('q')
+
+    def groups(self):
+        """
+        Yield (first, [(second, count), ...]) with firsts and seconds in order of first appearance.
+        """
+        if self.runs is not None:
+            yield from self.merged_groups()
+            return
+        group_slots = {}
+        for slot, first in enumerate(self.firsts):
+            group_slots.setdefault(first, []).append(slot)
+        for first, slots in group_slots.items():
+            yield first, [(self.seconds[slot], self.counts[slot]) for slot in slots]
+
+    def merged_groups(self):
+        """
+        groups() of a table that was spilled: add up the counts of every pair
+        across runs, then sort the groups back into order of first appearance.
+        """
+        self.spill()
+        order = ExternalSorter(self.budget, tmp_dir=self.tmp_dir)
+        for first, pairs in groupby(self.runs, key=itemgetter(0)):
+            merged = []
+            for second, same in groupby(pairs, key=itemgetter(1)):
+                same = list(same)
+                merged.append((min(pair[3] for pair in same), second, sum(pair[2] for pair in same)))
+            merged.sort()
+            order.add((merged[0][0], first, [(second, count) for seq, second, count in merged]))
+        for seq, first, seconds in order:
+            yield first, seconds
+        self.runs.close()
+        order.close()
+
+def read_run(run):
+    run.seek(0)
+    while True:
+        try:
+            chunk = pickle.load(run)
+        except EOFError:
+            break
+        yield from chunk
+
+class ExternalSorter:
+    """
+    Sort more items than fit in memory. Up to buffer_size items are kept
+    (all of them if it is None); every full buffer is sorted and pickled to
+    a temporary run file, and iterating merges the runs with a k-way heap merge.
+    With unique, duplicate items are dropped.
+    """
+    def __init__(self, buffer_size, key=None, unique=False, tmp_dir=None):
+        self.buffer_size = buffer_size
+        self.key = key
+        self.unique = unique
+        self.tmp_dir = tmp_dir
+        self.buffer = set() if unique else []
+        self.runs = []
+
+    def add(self, item):
+        if self.unique:
+            self.buffer.add(item)
+        else:
+            self.buffer.append(item)
+        if self.buffer_size is not None and len(self.buffer) >= self.buffer_size:
+            self.write_run(self.buffer)
+            self.buffer = set() if self.unique else []
+
+    def write_run(self, items):
+        """
+        Sort items and write them as one run.
+        """
+        items = sorted(items, key=self.key)
+        run = tempfile.TemporaryFile(dir=self.tmp_dir)
+        for start in range(0, len(items), run_chunk):
+            pickle.dump(items[start:start + run_chunk], run, pickle.HIGHEST_PROTOCOL)
+        self.runs.append(run)
+
+    def __iter__(self):
+        if self.runs:
+            if self.buffer:
+                self.write_run(self.buffer)
+                self.buffer = set() if self.unique else []
+            items = heapq.merge(*map(read_run, self.runs), key=self.key)
+        else:
+            items = iter(sorted(self.buffer, key=self.key))
+        if not self.unique:
+            return items
+        return (item for item, same in groupby(items))
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+
+def event_record(first, second, ngrams, count):
+    """
+    An event seen count times as one array: length of the rest, first id, second id,
+    count, number of n-grams, then the length and word ids of each n-gram.
+    """
+    record = array('q', (0, first, second, count, len(ngrams)))
+    for ngram in ngrams:
+        record.append(len(ngram))
+        record.extend(ngram)
+    record[0] = len(record) - 1
+    return record
+
+def read_event_records(ifile, byteswap=False):
+    """
+    Yield (first id, second id, n-gram tuples, count) from event records in ifile.
+    """
+    while True:
+        record = array('q')
+        try:
+            record.fromfile(ifile, 1)
+            if byteswap:
+                record.byteswap()
+            record.fromfile(ifile, record[0])
+        except EOFError:
+            break
+        if byteswap:
+            record.byteswap()
+            record[0] = len(record) - 1
+        ngrams, pos = [], 5
+        for _ in range(record[4]):
+            end = pos + 1 + record[pos]
+            ngrams.append(tuple(record[pos + 1:end]))
+            pos = end
+        yield record[1], record[2], ngrams, record[3]
+
+class EventSpill:
+    """
+    A list of (first id, second id, n-gram tuples, count) events kept in a temporary file.
+    """
+    def __init__(self, tmp_dir=None):
+        self.file = tempfile.TemporaryFile(dir=tmp_dir)
+
+    def append(self, event):
+        event_record(*event).tofile(self.file)
+
+    def __iter__(self):
+        self.file.seek(0)
+        return read_event_records(self.file)
+
+def ngram_string(vocab, ngram):
+    """
+    '^word1<tags>$ ^word2<tags>$' text of an n-gram of word ids.
+    """
+    return ' '.join('^{}$'.format(vocab[word_id]) for word_id in ngram)
+
+def ngram_hash(string):
+    """
+    63-bit hash of an n-gram text, the same in every run.
+    """
+    return int.from_bytes(hashlib.blake2b(string.encode('utf-8'), digest_size=8).digest(), 'little') >> 1
+
+class FeatureNumbers:
+    """
+    Number interned n-grams by the hash of their text, as HashedFeatures does,
+    so that an n-gram keeps its number whatever corpus it is counted in.
+    """
+    record_type = 'Q'
+
+    def __init__(self, vocab, ngrams):
+        self.vocab = vocab
+        self.ngrams = ngrams
+        self.numbers = {}
+
+    def number(self, ngram_id):
+        number = self.numbers.get(ngram_id)
+        if number is None:
+            number = self.numbers[ngram_id] = ngram_hash(ngram_string(self.vocab, self.ngrams[ngram_id]))
+        return number
+
+    def items(self):
+        """
+        (n-gram text, number) of the numbered n-grams, sorted by text.
+        """
+        strings = ((ngram_string(self.vocab, self.ngrams[ngram_id]), number)
+                   for ngram_id, number in self.numbers.items())
+        return sorted(strings, key=itemgetter(0))
+
+class HashedFeatures:
+    """
+    Number n-gram tuples by the hash of their text, so that no table of
+    features stays in memory; the numbered n-grams go to an external sort.
+    """
+    record_type = 'Q'
+
+    def __init__(self, vocab, budget, tmp_dir=None):
+        self.vocab = vocab
+        self.sorter = ExternalSorter(budget, unique=True, tmp_dir=tmp_dir)
+
+    def number(self, ngram):
+        string = ngram_string(self.vocab, ngram)
+        number = ngram_hash(string)
+        self.sorter.add((string, number))
+        return number
+
+    def items(self):
+        return iter(self.sorter)
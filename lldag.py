@@ -0,0 +1,57 @@
+"""
+Run the stages of a pipeline as a dependency graph.
+
+Every stage is a function of the results of the stages it depends on.
+Stages whose dependencies are done run at the same time, up to a limit,
+in threads of this process: most of their work is done by the tools
+they start. With a limit of 1, stages run one by one in the order they
+were added.
+"""
+
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+class StageGraph:
+    """
+    Named stages and the stages each depends on.
+    """
+    def __init__(self):
+        self.stages = {} # stages[name] = (func, names of dependencies)
+
+    def add(self, name, func, *deps):
+        """
+        Add a stage computed as func(*results of deps); deps must have been added before.
+        """
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError('stage {} depends on unknown stage {}'.format(name, dep))
+        self.stages[name] = (func, deps)
+
+    def run_stage(self, name, func, args):
+        btime = perf_counter()
+        result = func(*args)
+        print('{} done in {:f}'.format(name, perf_counter() - btime))
+        return result
+
+    def run(self, jobs=1):
+        """
+        Run all stages, at most jobs at once, and return {name: result}.
+        If a stage fails, no more stages are started and its exception
+        is raised once the running ones are done.
+        """
+        results, running = {}, {}
+        waiting = dict(self.stages)
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            while waiting or running:
+                for name, (func, deps) in list(waiting.items()):
+                    if len(running) == jobs:
+                        break
+                    if all(dep in results for dep in deps):
+                        del waiting[name]
+                        print('Running {}'.format(name))
+                        future = executor.submit(self.run_stage, name, func, [results[dep] for dep in deps])
+                        running[future] = name
+                done, pending = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+        return results
@@ -0,0 +1,105 @@
+"""
+Compact on-disk maxent events.
+
+Every event is one record of unsigned ints in machine byte order: word
+id, number of classes, outcome index, number of times it was seen,
+number of features, then the feature ids. The file starts with the array typecode of its records,
+'Q' for feature ids that are 63-bit hashes of the n-gram text. Words are
+numbered in order of first appearance and listed one per line in a
+'.words' sidecar. The yasmet text of an event, with every feature
+repeated once per class, is only built when its word is trained, and
+written once for every time the event was seen.
+"""
+
+from array import array
+
+head_size = 5
+
+def words_fname(event_fname):
+    return event_fname + '.words'
+
+class EventWriter:
+    """
+    Write event records, numbering the words on the way.
+    """
+    def __init__(self, fname, record_type='I'):
+        self.fname = fname
+        self.record_type = record_type
+        self.file = open(fname, 'wb')
+        self.file.write(record_type.encode('ascii'))
+        self.word_ids = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, word, nclasses, outcome, count, features):
+        word_id = self.word_ids.setdefault(word, len(self.word_ids))
+        record = array(self.record_type, (word_id, nclasses, outcome, count, len(features)))
+        record.extend(features)
+        record.tofile(self.file)
+
+    def close(self):
+        self.file.close()
+        with open(words_fname(self.fname), 'w', encoding='utf-8') as words_file:
+            for word in self.word_ids:
+                words_file.write('{}\n'.format(word))
+
+def read_words(event_fname):
+    """
+    Words of an events file, indexed by word id.
+    """
+    with open(words_fname(event_fname), 'r', encoding='utf-8') as words_file:
+        return [line.rstrip('\n') for line in words_file]
+
+def scan_events(event_fname):
+    """
+    Yield (offset, word id, number of classes, outcome, count, number of features)
+    for every record, skipping over the feature ids.
+    """
+    with open(event_fname, 'rb') as event_file:
+        record_type = event_file.read(1).decode('ascii')
+        itemsize = array(record_type).itemsize
+        offset = 1
+        while True:
+            head = event_file.read(head_size * itemsize)
+            if len(head) < head_size * itemsize:
+                break
+            word_id, nclasses, outcome, count, nfeatures = array(record_type, head)
+            yield offset, word_id, nclasses, outcome, count, nfeatures
+            offset += (head_size + nfeatures) * itemsize
+            event_file.seek(offset)
+
+def read_events(event_fname, offsets):
+    """
+    Yield (outcome, count, feature ids) of the records at the given offsets.
+    """
+    with open(event_fname, 'rb') as event_file:
+        record_type = event_file.read(1).decode('ascii')
+        for offset in offsets:
+            event_file.seek(offset)
+            head = array(record_type)
+            head.fromfile(event_file, head_size)
+            features = array(record_type)
+            features.fromfile(event_file, head[4])
+            yield head[2], head[3], features
+
+def hash_events(event_fname, offsets, hasher):
+    """
+    Add the outcomes, counts and feature ids of the records at the given offsets to hasher.
+    """
+    for outcome, count, features in read_events(event_fname, offsets):
+        hasher.update(array('Q', (outcome, count, len(features))).tobytes())
+        hasher.update(features.tobytes())
+    return hasher
+
+def yasmet_line(nclasses, outcome, features):
+    """
+    The event in yasmet format: 'outcome # f:0 g:0  # f:1 g:1  #'.
+    """
+    line = '{} # '.format(outcome)
+    for j in range(nclasses):
+        line += ''.join('{}:{} '.format(feature, j) for feature in features) + ' # '
+    return line.strip()
@@ -0,0 +1,135 @@
+"""
+Streaming file layer for intermediate files, with large buffers and
+optional gzip or zstd compression.
+
+Files are written compressed when their name ends in '.gz' or '.zst'
+(see compressed_fname), and read according to their content, so a stage
+reads its inputs the same way whatever wrote them. Appending to a
+compressed file adds a gzip member or zstd frame, read as one stream. zstd goes through the
+zstandard module when it is installed, otherwise through the zstd program.
+"""
+
+import io, gzip
+from subprocess import Popen, PIPE
+
+suffixes = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+gzip_magic = b'\x1f\x8b'
+zstd_magic = b'\x28\xb5\x2f\xfd'
+
+# set by configure()
+buffer_size = 1 << 20
+level = 3
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def configure(io_buffer_size, compression_level):
+    """
+    Set the buffer size and compression level of every file opened from now on.
+    """
+    global buffer_size, level
+    buffer_size, level = io_buffer_size, compression_level
+
+def compressed_fname(fname, compression):
+    """
+    fname with the suffix of compression (None, 'gzip' or 'zstd').
+    """
+    return fname + suffixes[compression]
+
+def plain_fname(fname):
+    """
+    fname without a compression suffix.
+    """
+    compression = name_compression(fname)
+    return fname[:-len(suffixes[compression])] if compression else fname
+
+def name_compression(fname):
+    """
+    The compression a file is written with, by its suffix.
+    """
+    for compression, suffix in suffixes.items():
+        if suffix and fname.endswith(suffix):
+            return compression
+    return None
+
+def file_compression(fname):
+    """
+    The compression of an existing file, by its first bytes.
+    """
+    with open(fname, 'rb') as ifile:
+        magic = ifile.read(4)
+    if magic.startswith(gzip_magic):
+        return 'gzip'
+    if magic == zstd_magic:
+        return 'zstd'
+    return None
+
+class ProcessStream(io.RawIOBase):
+    """
+    The stdin or stdout of a (de)compressing process as a raw stream;
+    closing it waits for the process.
+    """
+    def __init__(self, args, stdin=None, stdout=None):
+        self.process = Popen(args, stdin=stdin, stdout=stdout, bufsize=0)
+        self.stream = self.process.stdout if stdin is None else self.process.stdin
+        self.args = args
+
+    def readable(self):
+        return self.stream is self.process.stdout
+
+    def writable(self):
+        return self.stream is self.process.stdin
+
+    def readinto(self, buffer):
+        return self.stream.readinto(buffer)
+
+    def write(self, data):
+        return self.stream.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.stream.close()
+        status = self.process.wait()
+        super().close()
+        if status != 0:
+            raise OSError('"{}" exited with code {}'.format(' '.join(self.args), status))
+
+def open_binary(fname, mode):
+    """
+    Unbuffered file object of fname opened with mode 'rb', 'wb' or 'ab'.
+    """
+    if mode == 'rb':
+        compression = file_compression(fname)
+    else:
+        compression = name_compression(fname)
+    if compression == 'gzip':
+        return gzip.GzipFile(fname, mode, compresslevel=min(level, 9))
+    if compression == 'zstd':
+        if mode == 'rb':
+            if zstandard is not None:
+                return zstandard.ZstdDecompressor().stream_reader(open(fname, 'rb'), read_across_frames=True,
+                                                                  closefd=True)
+            return ProcessStream(['zstd', '-q', '-d', '-c', fname], stdout=PIPE)
+        if zstandard is not None:
+            return zstandard.ZstdCompressor(level=level).stream_writer(open(fname, mode), closefd=True)
+        with open(fname, mode) as ofile:
+            return ProcessStream(['zstd', '-q', '-{}'.format(level), '-c'], stdin=PIPE, stdout=ofile)
+    return open(fname, mode, buffering=0)
+
+def open_file(fname, mode='r'):
+    """
+    Open fname for reading, writing or appending ('r', 'w', 'a', 'rb', 'wb'
+    or 'ab') through a buffer of buffer_size bytes, in UTF-8 for text modes.
+    """
+    writing = not mode.startswith('r')
+    raw = open_binary(fname, mode[0] + 'b')
+    if writing:
+        binary = io.BufferedWriter(raw, buffer_size)
+    else:
+        binary = io.BufferedReader(raw, buffer_size)
+    if 'b' in mode:
+        return binary
+    return io.TextIOWrapper(binary, encoding='utf-8')
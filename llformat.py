@@ -0,0 +1,208 @@
+"""
+Parsers for Apertium stream format.
+
+get_default is the original character-by-character parser of the
+'^sl<tags>/tl<tags>/...$' units that prepare_data turns into global
+defaults. split_default gives the same results with one precompiled
+regex per line, and split_defaults runs it over a stream of lines.
+Unlike get_default, which stays escaped after its first backslash,
+split_default takes every backslash-escaped character as text.
+
+Candidates are also kept tokenised in a binary '.tokens' sidecar, so
+that later stages do not parse them again: one record of 'q' ints per
+candidate (length of the rest, then the sl ids, tl ids, biltrans tokens
+and alignment points, each preceded by their number; a biltrans token is
+its sl id, number of translations and their ids), with the words listed
+in a '.tokens.words' file after a line of JSON describing the sidecar.
+"""
+
+import os, sys, re, json
+from array import array
+
+tokens_format = 'lexlearner-candidate-tokens'
+tokens_version = 1
+
+def get_default(line):
+    lemma_tl = '';
+    tags_tl = '';
+    lemma_sl = '';
+    tags_sl = '';
+    state = 0;
+    escaped = False;
+    for c in line: #{
+        if c == '^': #{
+            state = 1; 
+            continue;
+        #}
+        if c == '\\': #{
+            escaped = True;
+            continue;
+        #}
+        if c == '<': #{
+            if state == 1: #{
+                state = 2; 
+            #}
+            if state == 3: #{
+                state = 4;
+            #}
+            continue;
+        #}
+        if c == '/' and state == 2 and not escaped: #{
+            state = 3    
+            continue;
+        #}
+        if c == '$' or (c == '/' and state > 2) and not escaped: #{
+            break;
+        #}
+
+        if state == 1: #{
+            lemma_sl = lemma_sl + c;
+        elif state == 2: #{    
+            if c == '>': #{
+                tags_sl = tags_sl + '.'    
+            elif c != '<': #{
+                tags_sl = tags_sl + c;
+            #}
+                
+        elif state == 3: #{
+            lemma_tl = lemma_tl + c;    
+        elif state == 4: #{
+            if c == '>': #{
+                tags_tl = tags_tl + '.'    
+            elif c != '<': #{
+                tags_tl = tags_tl + c;
+            #}
+        #}
+    #}    
+    tags_sl = tags_sl.strip('.');
+    tags_tl = tags_tl.strip('.');
+
+    return (lemma_sl, tags_sl, lemma_tl, tags_tl)
+
+# text before the unit, then its lemma, tags up to the first '/', and the first
+# translation's lemma and tags; no backslashes or second '^' (see split_default)
+default_re = re.compile(r'[^^$\\]*\^([^<$^\\]*)(?:(<[^/$^\\]*)(?:/([^</$^\\]*)([^/$^\\]*))?)?')
+
+# escaped characters the parsers would take as delimiters stand in a line
+# as noncharacters while it is split, and are put back in the result
+escape_re = re.compile(r'\\(.?)', re.DOTALL)
+escaped_chars = {c: chr(0xFDD0 + k) for k, c in enumerate('^$/<>\\')}
+unescape_table = str.maketrans({code: c for c, code in escaped_chars.items()})
+
+def split_default(line):
+    """
+    (sl lemma, sl tags, tl lemma, tl tags) of the first unit of line, tags joined with dots.
+    A backslash makes the next character text; units with a second '^'
+    before their end go through get_default.
+    """
+    if '\\' in line:
+        line = escape_re.sub(lambda match: escaped_chars.get(match.group(1), match.group(1)), line)
+        return tuple(field.translate(unescape_table) for field in split_default(line))
+    match = default_re.match(line)
+    if match is None:
+        return get_default(line)
+    end = match.end()
+    if end != len(line) and line[end] not in '/$':
+        return get_default(line)
+    lemma_sl, tags_sl, lemma_tl, tags_tl = match.groups('')
+    return (lemma_sl, tags_sl.replace('<', '').replace('>', '.').strip('.'),
+            lemma_tl, tags_tl.replace('<', '').replace('>', '.').strip('.'))
+
+def split_defaults(lines):
+    """
+    Yield split_default of every line.
+    """
+    for line in lines:
+        yield split_default(line)
+
+def tokens_fname(cand_fname):
+    return cand_fname + '.tokens'
+
+class TokensWriter:
+    """
+    Write the tokenised candidates of a candidates file as it is written.
+    The sidecar only appears once close() is called with the finished candidates.
+    """
+    def __init__(self, cand_fname):
+        self.cand_fname = cand_fname
+        self.fname = tokens_fname(cand_fname)
+        self.file = open(self.fname + '.tmp', 'wb')
+
+    def write(self, sl_ids, bt_ids, tl_ids, al_index):
+        """
+        Write one candidate; bt_ids are (sl id, tl ids) pairs.
+        """
+        record = array('q', (0, len(sl_ids)))
+        record.extend(sl_ids)
+        record.append(len(tl_ids))
+        record.extend(tl_ids)
+        record.append(len(bt_ids))
+        for sl_id, tls in bt_ids:
+            record.extend((sl_id, len(tls)))
+            record.extend(tls)
+        points = [(sl, tl) for sl, tls in al_index.items() for tl in tls]
+        record.append(len(points))
+        for point in points:
+            record.extend(point)
+        record[0] = len(record) - 1
+        record.tofile(self.file)
+
+    def close(self, vocab):
+        self.file.close()
+        header = {'format': tokens_format, 'version': tokens_version, 'byteorder': sys.byteorder,
+                  'candidates_size': os.path.getsize(self.cand_fname)}
+        with open(self.fname + '.words', 'w', encoding='utf-8') as words_file:
+            words_file.write(json.dumps(header, sort_keys=True) + '\n')
+            for word_id in range(len(vocab)):
+                words_file.write(vocab[word_id] + '\n')
+        os.replace(self.fname + '.tmp', self.fname)
+
+def read_tokens_words(cand_fname):
+    """
+    Words of the tokens sidecar of a candidates file,
+    or None if there is no sidecar for its current contents.
+    """
+    fname = tokens_fname(cand_fname)
+    if not os.path.exists(fname) or not os.path.exists(fname + '.words'):
+        return None
+    with open(fname + '.words', 'r', encoding='utf-8') as words_file:
+        header = json.loads(words_file.readline())
+        if (header.get('format') != tokens_format or header.get('version') != tokens_version
+                or header['byteorder'] != sys.byteorder
+                or header['candidates_size'] != os.path.getsize(cand_fname)):
+            return None
+        return [line.rstrip('\n') for line in words_file]
+
+def read_tokens(cand_fname, start=0, stop=None):
+    """
+    Yield (sl ids, biltrans (sl id, tl ids) pairs, tl ids, alignment index)
+    of candidates start to stop (all by default) from the tokens sidecar.
+    """
+    with open(tokens_fname(cand_fname), 'rb') as tokens_file:
+        number = 0
+        while stop is None or number < stop:
+            size = array('q')
+            try:
+                size.fromfile(tokens_file, 1)
+            except EOFError:
+                break
+            number += 1
+            if number <= start:
+                tokens_file.seek(size[0] * size.itemsize, os.SEEK_CUR)
+                continue
+            record = array('q')
+            record.fromfile(tokens_file, size[0])
+            pos = record[0] + 1
+            sl_ids = record[1:pos]
+            tl_ids = record[pos + 1:pos + 1 + record[pos]]
+            pos += 1 + record[pos]
+            bt_ids = []
+            for _ in range(record[pos]):
+                ntls = record[pos + 2]
+                bt_ids.append((record[pos + 1], record[pos + 3:pos + 3 + ntls]))
+                pos += 2 + ntls
+            pos += 1
+            al_index = {}
+            for k in range(pos + 1, pos + 1 + 2 * record[pos], 2):
+                al_index.setdefault(record[k], []).append(record[k + 1])
+            yield sl_ids, bt_ids, tl_ids, al_index
@@ -0,0 +1,172 @@
+"""
+Long-lived Apertium/lex-tools processes running in null-flush mode.
+
+Every command (a shell pipeline of tools started with -z) gets a few warm
+processes that are fed batches of lines terminated by a null character,
+so transducers are loaded once per run instead of once per stage.
+"""
+
+import os, threading, queue, atexit, itertools
+from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from llfile import open_file
+from llcache import make_key, file_stamp, read_progress, write_progress, clear_progress
+
+class NullFlushWorker:
+    """
+    One running command; translate() sends a batch and waits for the flush.
+    """
+    def __init__(self, command):
+        self.command = command
+        self.process = Popen(command, shell=True, stdin=PIPE, stdout=PIPE)
+        self.pending = b''
+
+    def _write(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def translate(self, lines):
+        """
+        Send lines (without newlines) as one null-terminated batch,
+        return the translated lines.
+        """
+        data = '\n'.join(lines).encode('utf-8') + b'\n\0'
+        # write from a separate thread: tools may start answering
+        # before they have read the whole batch
+        writer = threading.Thread(target=self._write, args=(data,))
+        writer.start()
+        out = self.pending
+        fd = self.process.stdout.fileno()
+        while b'\0' not in out:
+            chunk = os.read(fd, 1 << 16)
+            if not chunk:
+                writer.join()
+                raise RuntimeError('"{}" exited with code {}'.format(self.command, self.process.wait()))
+            out += chunk
+        writer.join()
+        out, self.pending = out.split(b'\0', 1)
+        out = out.decode('utf-8')
+        if out.endswith('\n'):
+            out = out[:-1]
+        out_lines = out.split('\n')
+        if len(out_lines) != len(lines):
+            raise RuntimeError('"{}" returned {} lines for {}'.format(self.command, len(out_lines), len(lines)))
+        return out_lines
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+class WorkerPool:
+    """
+    Warm workers grouped by command, shared by all pipeline stages.
+    """
+    def __init__(self, size, batch_lines):
+        self.size = size
+        self.batch_lines = batch_lines
+        self.lock = threading.Lock()
+        self.idle = {}      # idle[command] = queue of idle workers
+        self.workers = {}   # workers[command] = [all workers]
+
+    def _acquire(self, command, workers):
+        with self.lock:
+            self.idle.setdefault(command, queue.Queue())
+            self.workers.setdefault(command, [])
+            if self.idle[command].empty() and len(self.workers[command]) < workers:
+                worker = NullFlushWorker(command)
+                self.workers[command].append(worker)
+                return worker
+        return self.idle[command].get()
+
+    def translate(self, command, lines, workers=None):
+        """
+        Translate one batch of lines on any worker of command.
+        """
+        worker = self._acquire(command, workers or self.size)
+        try:
+            return worker.translate(lines)
+        finally:
+            self.idle[command].put(worker)
+
+    def map(self, command, lines, workers=None):
+        """
+        Translate an iterable of lines, yielding the translated lines in order.
+        Up to workers batches are in flight at once.
+        """
+        workers = workers or self.size
+        in_flight = deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            batch = []
+            for line in lines:
+                batch.append(line.rstrip('\n'))
+                if len(batch) == self.batch_lines:
+                    in_flight.append(executor.submit(self.translate, command, batch, workers))
+                    batch = []
+                    if len(in_flight) > workers:
+                        yield from in_flight.popleft().result()
+            if batch:
+                in_flight.append(executor.submit(self.translate, command, batch, workers))
+            while in_flight:
+                yield from in_flight.popleft().result()
+
+    def copy(self, command, ifname, ofname, limit=None, workers=None, start=0, checkpoint=None, resume=False):
+        """
+        Translate the file ifname from line start on into ofname, stopping after limit lines.
+        Both files may be compressed (see llfile). Return the number of lines translated.
+        """
+        def read_lines(skip):
+            with open_file(ifname, 'r') as ifile:
+                stop = None if limit is None else start + limit
+                yield from itertools.islice(ifile, start + skip, stop)
+        key = make_key('copy', command, file_stamp(ifname), start, limit)
+        return self.copy_lines(command, read_lines, ofname, key, workers, checkpoint, resume)
+
+    def copy_lines(self, command, read_lines, ofname, key, workers=None, checkpoint=None, resume=False):
+        """
+        Translate the lines read_lines(0) yields into ofname; return their number.
+        With checkpoint, the output is closed and its progress recorded under key
+        every checkpoint lines; with resume, a copy that stopped goes on from its
+        last checkpoint, reading read_lines(lines done).
+        """
+        done, mode = 0, 'w' # lines in ofname
+        progress = resume and read_progress(ofname, key)
+        if progress and os.path.exists(ofname) and os.path.getsize(ofname) >= progress['size']:
+            os.truncate(ofname, progress['size'])
+            done, mode = progress['lines'], 'a'
+        lines = self.map(command, read_lines(done), workers)
+        while True:
+            written = 0
+            with open_file(ofname, mode) as ofile:
+                for line in itertools.islice(lines, checkpoint):
+                    ofile.write(line + '\n')
+                    written += 1
+            done += written
+            if checkpoint is None or written < checkpoint:
+                break
+            write_progress(ofname, key, {'lines': done, 'size': os.path.getsize(ofname)})
+            mode = 'a'
+        clear_progress(ofname)
+        return done
+
+    def close(self):
+        """
+        Stop all workers.
+        """
+        with self.lock:
+            for command, workers in self.workers.items():
+                for worker in workers:
+                    worker.close()
+            self.idle, self.workers = {}, {}
+
+_pool = None
+
+def get_pool(size, batch_lines):
+    """
+    Return the pool shared by the whole run, creating it on first use.
+    """
+    global _pool
+    if _pool is None:
+        _pool = WorkerPool(size, batch_lines)
+        atexit.register(_pool.close)
+    return _pool
@@ -0,0 +1,224 @@
+"""
+Per-stage profile of a run, saved as a JSON run report.
+
+Stage functions are wrapped with @stage. Every call records its wall
+time, the CPU time of this process and of its child processes (the
+Apertium tools, moses and yasmet, where most of the work is done), peak
+RSS of both, the lines it read and wrote, as counted by the stage itself
+with add_lines, and the sizes of the files it read and wrote: its file
+arguments and any files noted with add_inputs, and the files in its
+result. On Linux, child CPU and memory include the warm null-flush
+workers, which only exit at the end of the run; elsewhere only children
+that have exited are counted. Child CPU is process-wide, so stages
+running at the same time share it; so is peak RSS when the report is
+concurrent, and the records say so.
+"""
+
+import os, json, time, threading, functools, datetime
+try:
+    import resource
+except ImportError:
+    resource = None
+
+clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+def proc_stats():
+    """
+    {pid: (parent pid, CPU seconds of the process and its reaped children)}
+    of all processes, or {} without /proc.
+    """
+    stats = {}
+    if not os.path.isdir('/proc'):
+        return stats
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(pid), 'rb') as stat_file:
+                fields = stat_file.read().rsplit(b')', 1)[1].split()
+        except OSError:
+            continue
+        # fields[0] is the state: ppid, utime, stime, cutime, cstime are fields 4, 14-17 of stat
+        cpu = sum(int(field) for field in fields[11:15]) / clock_ticks
+        stats[int(pid)] = (int(fields[1]), cpu)
+    return stats
+
+def descendants(stats, root):
+    children = {}
+    for pid, (ppid, cpu) in stats.items():
+        children.setdefault(ppid, []).append(pid)
+    pids, todo = [], [root]
+    while todo:
+        for child in children.get(todo.pop(), ()):
+            pids.append(child)
+            todo.append(child)
+    return pids
+
+def peak_rss(pid):
+    """
+    Peak RSS of a live process in kB (VmHWM), 0 if unknown.
+    """
+    try:
+        with open('/proc/{}/status'.format(pid), 'r') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+def usage():
+    """
+    (CPU seconds of this process, CPU seconds of all its descendants,
+    peak RSS of this process in kB, largest peak RSS of a descendant in kB).
+    """
+    self_cpu = time.process_time()
+    if resource is None:
+        return self_cpu, 0.0, 0, 0
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    child_cpu, child_rss = children.ru_utime + children.ru_stime, children.ru_maxrss
+    stats = proc_stats()
+    for pid in descendants(stats, os.getpid()):
+        child_cpu += stats[pid][1]
+        child_rss = max(child_rss, peak_rss(pid))
+    self_rss = peak_rss(os.getpid()) or resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return self_cpu, child_cpu, self_rss, child_rss
+
+def reset_peak_rss():
+    """
+    Start measuring this process's peak RSS afresh, where Linux allows it.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+def file_lines(fname):
+    """
+    Number of lines of a text file, None for a binary one.
+    """
+    with open(fname, 'rb') as ifile:
+        block = ifile.read(1 << 20)
+        if b'\0' in block:
+            return None
+        lines = 0
+        while block:
+            lines += block.count(b'\n')
+            block = ifile.read(1 << 20)
+    return lines
+
+def file_names(values):
+    """
+    Names of existing files among values, nested lists and tuples included.
+    """
+    fnames = []
+    for value in values:
+        if isinstance(value, str):
+            if os.path.isfile(value):
+                fnames.append(value)
+        elif isinstance(value, (list, tuple)):
+            fnames.extend(file_names(value))
+    return fnames
+
+def file_sizes(fnames):
+    """
+    Bytes of files.
+    """
+    return sum(os.path.getsize(fname) for fname in set(fnames))
+
+class RunReport:
+    """
+    Stage records of one run, written to fname after every stage;
+    nothing is measured while fname is None. When concurrent, stages
+    may run at the same time, and the peak RSS recorded is that of the
+    whole process rather than of one stage.
+    """
+    def __init__(self):
+        self.fname = None
+        self.concurrent = False
+        self.started = datetime.datetime.now().isoformat(timespec='seconds')
+        self.start_time = time.perf_counter()
+        self.config = {}
+        self.stages = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def add_inputs(self, *fnames):
+        """
+        Note files read by the current stage that are not among its arguments.
+        """
+        if getattr(self.local, 'inputs', None) is not None:
+            self.local.inputs.extend(file_names(fnames))
+
+    def add_lines(self, lines_in=0, lines_out=0):
+        """
+        Count lines read and written by the current stage.
+        """
+        lines = getattr(self.local, 'lines', None)
+        if lines is not None:
+            lines[0] += lines_in
+            lines[1] += lines_out
+
+    def stage(self, func):
+        """
+        Decorator recording every call of func as a stage.
+        """
+        @functools.wraps(func)
+        def run_stage(*args, **kwargs):
+            if self.fname is None:
+                return func(*args, **kwargs)
+            outer_inputs = getattr(self.local, 'inputs', None)
+            outer_lines = getattr(self.local, 'lines', None)
+            self.local.inputs = inputs = file_names(args) + file_names(kwargs.values())
+            self.local.lines = lines = [0, 0]
+            if not self.concurrent:
+                # other stages would lose their peak
+                reset_peak_rss()
+            before = usage()
+            wall = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                self.local.inputs = outer_inputs
+                self.local.lines = outer_lines
+            wall = time.perf_counter() - wall
+            after = usage()
+            self.record(func.__name__, wall, before, after, inputs, lines, result)
+            return result
+        return run_stage
+
+    def record(self, name, wall, before, after, inputs, lines, result):
+        lines_in, lines_out = lines
+        bytes_in = file_sizes(inputs)
+        bytes_out = file_sizes(fname for fname in file_names([result]) if fname not in inputs)
+        entry = {'stage': name,
+                 'wall_seconds': round(wall, 3),
+                 'cpu_seconds': round(after[0] - before[0], 3),
+                 'child_cpu_seconds': round(after[1] - before[1], 3),
+                 'peak_rss_kb': after[2],
+                 'peak_child_rss_kb': after[3],
+                 'peak_rss_scope': 'process' if self.concurrent else 'stage',
+                 'lines_in': lines_in, 'lines_out': lines_out,
+                 'bytes_in': bytes_in, 'bytes_out': bytes_out,
+                 'lines_per_second': round((lines_in or lines_out) / wall, 1) if wall > 0 else None}
+        with self.lock:
+            self.stages.append(entry)
+        self.save()
+
+    def save(self):
+        if self.fname is None:
+            return
+        with self.lock:
+            report = {'started': self.started,
+                      'wall_seconds': round(time.perf_counter() - self.start_time, 3),
+                      'config': self.config,
+                      'stages': self.stages}
+            with open(self.fname + '.tmp', 'w', encoding='utf-8') as ofile:
+                json.dump(report, ofile, indent=1)
+            os.replace(self.fname + '.tmp', self.fname)
+
+report = RunReport()
+stage = report.stage
+add_inputs = report.add_inputs
+add_lines = report.add_lines
@@ -0,0 +1,90 @@
+"""
+Self-describing count shards, the result of counting one slice of a
+candidates file on any machine.
+
+A shard starts with one line of JSON telling its format, byte order,
+the slice of candidates it covers, the config it was counted with and
+the size of its sections. Then come its words, one per line, and the
+word-id sections as arrays of 'q' ints: (sl id, tl id, count) triples of
+the frequency lexicon, then event records (see llcount.event_record)
+up to the end of the file. Shards of consecutive slices merge into the
+same counts as one pass over the whole file.
+"""
+
+import os, sys, json
+from array import array
+from llcount import event_record, read_event_records
+
+shard_format = 'lexlearner-count-shard'
+shard_version = 2
+
+def write_shard(shard_fname, info, vocab, sl_tl, events):
+    """
+    Write the words, pair counts and events of one slice to a shard.
+    The shard only appears under its name once it is complete.
+    """
+    pairs = array('q')
+    for sl_id, tl_freqs in sl_tl.groups():
+        for tl_id, freq in tl_freqs:
+            pairs.extend((sl_id, tl_id, freq))
+    header = dict(info, format=shard_format, version=shard_version, byteorder=sys.byteorder,
+                  words=len(vocab), pairs=len(pairs) // 3)
+    with open(shard_fname + '.tmp', 'wb') as shard:
+        shard.write((json.dumps(header, sort_keys=True) + '\n').encode('utf-8'))
+        for word_id in range(len(vocab)):
+            shard.write((vocab[word_id] + '\n').encode('utf-8'))
+        pairs.tofile(shard)
+        for event in events:
+            event_record(*event).tofile(shard)
+    os.replace(shard_fname + '.tmp', shard_fname)
+
+def read_shard_info(shard_fname):
+    """
+    The header of a shard.
+    """
+    with open(shard_fname, 'rb') as shard:
+        info = json.loads(shard.readline().decode('utf-8'))
+    if info.get('format') != shard_format or info.get('version') != shard_version:
+        raise ValueError('{} is not a version {} count shard'.format(shard_fname, shard_version))
+    return info
+
+def read_shard_counts(shard_fname):
+    """
+    Return the header, words and (sl id, tl id, count) array of a shard.
+    """
+    info = read_shard_info(shard_fname)
+    with open(shard_fname, 'rb') as shard:
+        shard.readline()
+        words = [shard.readline().decode('utf-8').rstrip('\n') for _ in range(info['words'])]
+        pairs = array('q')
+        pairs.fromfile(shard, info['pairs'] * 3)
+    if info['byteorder'] != sys.byteorder:
+        pairs.byteswap()
+    return info, words, pairs
+
+def read_shard_events(shard_fname):
+    """
+    Yield the (sl id, tl id, n-gram tuples, count) events of a shard.
+    """
+    info = read_shard_info(shard_fname)
+    with open(shard_fname, 'rb') as shard:
+        for _ in range(info['words'] + 1):
+            shard.readline()
+        shard.seek(info['pairs'] * 3 * array('q').itemsize, os.SEEK_CUR)
+        yield from read_event_records(shard, info['byteorder'] != sys.byteorder)
+
+def check_shards(infos):
+    """
+    Raise ValueError unless the shards, in order, were counted with the same
+    config and the shards of each candidates file cover consecutive slices.
+    """
+    for prev, cur in zip(infos, infos[1:]):
+        if prev['max_ngrams'] != cur['max_ngrams']:
+            raise ValueError('count shards of different config: {} and {}'.format(
+                describe_shard(prev), describe_shard(cur)))
+        if prev['candidates'] == cur['candidates'] and prev['stop'] != cur['start']:
+            raise ValueError('count shards are not consecutive: {} and {}'.format(
+                describe_shard(prev), describe_shard(cur)))
+
+def describe_shard(info):
+    return '{candidates}[{start}:{stop}] (max_ngrams {max_ngrams})'.format(**info)